@@ -4,7 +4,8 @@ __version__ = '0.2a1.dev4'
 
 try:
     from notification.models import create_notice_type, get_notification_language, \
-    	send_now, send, queue, observe, stop_observing, send_observation_notices_for, \
+    	get_notification_languages, \
+    	send_now, send_async, send, queue, observe, stop_observing, send_observation_notices_for, \
     	is_observing, handle_observations
 except ImportError:
     pass
\ No newline at end of file
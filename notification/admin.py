@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from notification.models import NoticeType, NoticeSetting, Notice, ObservedItem, NoticeQueueBatch
+from notification.models import NoticeType, NoticeSetting, Notice, ObservedItem, NoticeQueueBatch, \
+    FailedNotice
 
 
 class NoticeTypeAdmin(admin.ModelAdmin):
@@ -14,8 +15,15 @@ class NoticeAdmin(admin.ModelAdmin):
     list_display = ["message", "recipient", "sender", "notice_type", "added", "unseen", "archived"]
 
 
+class FailedNoticeAdmin(admin.ModelAdmin):
+    list_display = ["label", "recipient", "backend", "retries", "last_failed", "next_retry"]
+    list_filter = ["backend", "label"]
+    raw_id_fields = ["recipient", "payload"]
+
+
 admin.site.register(NoticeQueueBatch)
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
 admin.site.register(Notice, NoticeAdmin)
 admin.site.register(ObservedItem)
+admin.site.register(FailedNotice, FailedNoticeAdmin)
@@ -1,3 +1,5 @@
+import sys
+
 from django.utils import importlib
 from django.core.exceptions import ImproperlyConfigured
 
@@ -50,6 +52,54 @@ def get_backends():
 
 backends = get_backends()
 
+def open_backends(backends, on_error=None):
+    for backend in backends:
+        backend.open(on_error)
+
+def flush_backends(backends, on_error=None):
+    """
+    Flushes the work buffered by the backends, in a fixed order, reporting
+    the buffered sends that fail for single recipients to ``on_error``. All
+    backends get the chance to flush before the first error is re-raised.
+    """
+    exc_info = None
+    for backend in sorted(backends, key=lambda backend: backend.slug):
+        # a batch of its own so the failures reach this on_error, also
+        # when the enclosing batch was opened by someone else
+        backend.open(on_error)
+        try:
+            backend.flush()
+        except Exception:
+            if exc_info is None:
+                exc_info = sys.exc_info()
+        finally:
+            try:
+                backend.close()
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+def discard_backends(backends):
+    for backend in backends:
+        backend.discard()
+
+def close_backends(backends):
+    """
+    Closes the current batch of every backend. All backends get the chance to
+    flush before the first error is re-raised.
+    """
+    exc_info = None
+    for backend in backends:
+        try:
+            backend.close()
+        except Exception:
+            if exc_info is None:
+                exc_info = sys.exc_info()
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
 def get_backend_field_choices():
     choices = []
     for backend in backends:
@@ -1,12 +1,77 @@
-from django.template import Context
-from django.template.loader import render_to_string
+import threading
+
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import select_template
 from itertools import chain
 
+from notification.settings import TEMPLATE_CACHE
+
+
+class TemplateCache(object):
+    """
+    Per-process cache of the resolved and compiled notification templates,
+    keyed by ``(backend slug, label, template name)``.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.templates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, backend, label, template):
+        key = (backend.slug, label, template)
+        try:
+            compiled = self.templates[key]
+        except KeyError:
+            self.misses += 1
+            compiled = select_template(backend.template_names(label,
+                    template))
+            if self.enabled:
+                self.templates[key] = compiled
+        else:
+            self.hits += 1
+        return compiled
+
+    def warm(self, backends, labels):
+        """
+        Resolves and compiles every template the given backends use for the
+        given notice type labels. Meant to be called once at startup.
+        """
+        for backend in backends:
+            for label in labels:
+                for template in backend.get_formats() + backend.templates:
+                    try:
+                        self.get(backend, label, template)
+                    except TemplateDoesNotExist:
+                        pass
+
+    def clear(self):
+        """
+        Drops the compiled templates, e.g. after editing them in development.
+        """
+        self.templates = {}
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.templates),
+        }
+
+template_cache = TemplateCache(TEMPLATE_CACHE)
+
+
 class NotificationBackend(object):
     slug = None
     display_name = None
     sensitivity = 2
+    # whether send mostly waits on the network and may run on worker threads
+    io_bound = False
     format_templates = {}
+    formats = []
+    # the templates send renders in addition to the formats
+    templates = []
 
     def path(self):
        return  "%s.%s" % (self.__module__, self.__class__.__name__)
@@ -14,6 +79,12 @@ class NotificationBackend(object):
     def get_formats(self):
         return self.formats
 
+    def template_names(self, label, template):
+        return ('notification/%s/%s/%s' % (self.slug, label, template),
+                'notification/%s/%s/%s' % (label, self.slug, template),
+                'notification/%s/%s' % (label, template),
+                'notification/%s' % template)
+
     def format_message(self, label, template, context):
         """
         Returns a dictionary with the format identifier as the key. The values are
@@ -24,28 +95,130 @@ class NotificationBackend(object):
             context.autoescape = False
         else:
             context.autoescape = True
-        return render_to_string(
-                    ('notification/%s/%s/%s' % (self.slug, label, template),
-                    'notification/%s/%s/%s' % (label, self.slug, template),
-                    'notification/%s/%s' % (label, template),
-                    'notification/%s' % template),
-                context_instance=context)
+        return template_cache.get(self, label, template).render(context)
     
     def should_send(self, sender, recipient, notice_type, *args, **kwargs):
-        return (recipient.is_active and
-                notice_type.get_setting(recipient, self).send)
+        """
+        Returns True if the recipient is active and wants to receive
+        ``notice_type`` through this backend. The decision is looked up in
+        the ``preferences`` map precomputed by ``send_now`` when given.
+        """
+        if not recipient.is_active:
+            return False
+        preferences = kwargs.get("preferences")
+        if preferences is not None:
+            try:
+                return preferences[(recipient.pk, self.path())]
+            except KeyError:
+                pass
+        return notice_type.get_setting(recipient, self).send
 
     def display_name(self):
         raise NotImplementedError
 
+    def prepare(self, sender, recipients, notice_type):
+        """
+        Called with every recipient before a batch of notices is sent, so
+        backends can load what they need in bulk.
+        """
+        pass
+
+    def state(self):
+        """
+        Returns the per-thread delivery state of this backend. Backends are
+        shared by all threads, so buffered work must never be stored on the
+        instance itself.
+        """
+        return self.__dict__.setdefault("_local", threading.local())
+
+    def open(self, on_error=None):
+        """
+        Starts a delivery batch. Until the outermost batch is closed the
+        backend may buffer the work done by ``send``. Batches can be nested.
+
+        The ``on_error(backend, recipient, exc_info)`` callable given to the
+        innermost open batch that has one is called for every buffered send
+        that fails for a single recipient when the work is flushed, see
+        ``report_error``.
+        """
+        state = self.state()
+        state.depth = getattr(state, "depth", 0) + 1
+        state.__dict__.setdefault("on_error", []).append(on_error)
+
+    def close(self):
+        """
+        Ends a delivery batch and flushes the buffered work when the outermost
+        batch is closed.
+        """
+        state = self.state()
+        state.depth -= 1
+        try:
+            if not state.depth:
+                self.flush()
+        finally:
+            state.on_error.pop()
+
+    def batching(self):
+        return getattr(self.state(), "depth", 0) > 0
+
+    def flush(self):
+        """
+        Delivers the work buffered during the current batch. Sends failing
+        for a single recipient are handed to ``report_error``.
+        """
+        pass
+
+    def discard(self):
+        """
+        Drops the work buffered during the current batch without delivering
+        it, e.g. when the batch is interrupted and will be sent again.
+        """
+        pass
+
+    def report_error(self, recipient, exc_info):
+        """
+        Reports a buffered send that failed for ``recipient`` to the
+        ``on_error`` callable of the innermost batch that has one, or
+        re-raises the error when none has.
+        """
+        for on_error in reversed(getattr(self.state(), "on_error", [])):
+            if on_error is not None:
+                on_error(self, recipient, exc_info)
+                return
+        raise exc_info[0], exc_info[1], exc_info[2]
+
     def send(self, sender, recipient, notice_type, context, *args, **kwargs):
         raise NotImplementedError
 
+    def flatten_context(self, context):
+        """
+        Returns the variables of ``context`` as a single dictionary, computed
+        once per recipient when the context carries a ``render_memo``.
+        """
+        memo = getattr(context, "render_memo", {})
+        if "context" not in memo:
+            memo["context"] = dict(chain(*([data.iteritems()
+                    for data in context])))
+        return memo["context"]
+
+    def render_format(self, label, format_template, context):
+        """
+        Renders ``format_template`` with the flattened ``context``. When the
+        context carries a ``render_memo`` (as the contexts built by
+        ``send_now`` do) each resolved format is rendered at most once per
+        recipient, whichever backend or template asks for it.
+        """
+        memo = getattr(context, "render_memo", {})
+        compiled = template_cache.get(self, label, format_template)
+        key = (label, compiled.name)
+        if key not in memo:
+            memo[key] = self.format_message(label, format_template,
+                    Context(self.flatten_context(context)))
+        return memo[key]
+
     def render_message(self, label, template, format_template, context):
         if 'message' not in context:
-            context = Context(
-                dict(chain(*([data.iteritems() for data in context])))
-            )
-            message = self.format_message(label, format_template, context)
+            message = self.render_format(label, format_template, context)
+            context = Context(self.flatten_context(context))
             context.update({'message': message})
         return self.format_message(label, template, context)
@@ -1,21 +1,31 @@
+import sys
+import logging
+import smtplib
+import socket
+
 from django.conf import settings
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
 
 from notification.backends.base import NotificationBackend
+from notification.settings import EMAIL_BATCH_SIZE, EMAIL_RETRIES
+
+log = logging.getLogger(__name__)
 
 
 class EmailBackend(NotificationBackend):
     sensitivity = 3
     slug = u'email'
     display_name = u'E-mail'
+    io_bound = True
     formats = ['short.txt', 'full.txt']
+    templates = ['email_subject.txt', 'email_body.txt']
 
     def email_for_user(self, recipient):
         return recipient.email
 
     def should_send(self, sender, recipient, notice_type, *args, **kwargs):
         send = super(EmailBackend, self).should_send(sender, recipient,
-                notice_type)
+                notice_type, *args, **kwargs)
         return send and self.email_for_user(recipient) != ''
 
     def render_subject(self, label, context):
@@ -25,18 +35,98 @@ class EmailBackend(NotificationBackend):
                 ).splitlines())
 
     def send(self, sender, recipient, notice_type, context, *args, **kwargs):
-        if not self.should_send(sender, recipient, notice_type):
+        """
+        Sends the e-mail right away, or inside a delivery batch queues it to
+        be sent with the others through a single connection every
+        ``NOTIFICATION_EMAIL_BATCH_SIZE`` messages and when the batch is
+        closed.
+        """
+        preferences = kwargs.pop("preferences", None)
+        if not self.should_send(sender, recipient, notice_type,
+                preferences=preferences):
             return False
 
         headers = kwargs.get('headers', {})
         headers.setdefault('Reply-To', settings.DEFAULT_FROM_EMAIL)
 
-        EmailMessage(self.render_subject(notice_type.label, context),
+        message = EmailMessage(self.render_subject(notice_type.label, context),
                 self.render_message(notice_type.label,
                         'email_body.txt',
                         'full.txt',
                         context),
                 kwargs.get('from_email') or settings.DEFAULT_FROM_EMAIL,
                 [self.email_for_user(recipient)],
-                headers=headers).send()
+                headers=headers)
+        if self.batching():
+            pending = self.state().__dict__.setdefault("messages", [])
+            pending.append((message, recipient))
+            if len(pending) >= EMAIL_BATCH_SIZE:
+                self.flush()
+        else:
+            message.send()
         return True
+
+    def send_messages(self, messages):
+        """
+        Sends the ``(message, recipient)`` pairs through the connection of
+        the current batch, reconnecting up to ``NOTIFICATION_EMAIL_RETRIES``
+        times in a row when the connection fails. A message refused by the server is
+        reported for its recipient and the others are still sent; when the
+        server cannot be reached the remaining messages are all reported.
+        """
+        state = self.state()
+        attempt = 0
+        for i, (message, recipient) in enumerate(messages):
+            while True:
+                try:
+                    if getattr(state, "connection", None) is None:
+                        state.connection = get_connection()
+                        # opened explicitly so send_messages keeps it open
+                        state.connection.open()
+                    state.connection.send_messages([message])
+                except (smtplib.SMTPServerDisconnected,
+                        smtplib.SMTPConnectError, socket.error):
+                    self.close_connection()
+                    if attempt >= EMAIL_RETRIES:
+                        exc_info = sys.exc_info()
+                        for message, recipient in messages[i:]:
+                            self.report_error(recipient, exc_info)
+                        return
+                    attempt += 1
+                    log.warning("e-mail connection failed, reconnecting "
+                            "(attempt %s of %s)" % (attempt, EMAIL_RETRIES))
+                except smtplib.SMTPException:
+                    self.report_error(recipient, sys.exc_info())
+                    break
+                else:
+                    # relays may hang up every so many messages
+                    attempt = 0
+                    break
+
+    def close_connection(self):
+        state = self.state()
+        connection = getattr(state, "connection", None)
+        if connection is not None:
+            state.connection = None
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def flush(self):
+        state = self.state()
+        messages = getattr(state, "messages", None)
+        if messages:
+            state.messages = []
+            for i in xrange(0, len(messages), EMAIL_BATCH_SIZE):
+                self.send_messages(messages[i:i + EMAIL_BATCH_SIZE])
+
+    def discard(self):
+        self.state().messages = []
+
+    def close(self):
+        try:
+            super(EmailBackend, self).close()
+        finally:
+            if not self.batching():
+                self.close_connection()
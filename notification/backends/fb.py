@@ -1,7 +1,12 @@
+import sys
+import urllib
+
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import simplejson
 
 from notification.backends.base import NotificationBackend
-from notification.utils import unescape
+from notification.settings import FACEBOOK_BATCH_SIZE
+from notification.utils import unescape, load_profiles
 
 import facebook
 
@@ -9,53 +14,105 @@ import logging
 log = logging.getLogger(__name__)
 
 
+class WallPostRejected(Exception):
+    """A wall post of a batched Graph API request that Facebook answered
+    with an error response."""
+
+
 class FacebookBackend(NotificationBackend):
     sensitivity = 3
     slug = u"facebook"
+
+    def memoize(self, name, user, function):
+        """Return ``function()``, computed once per user for the current
+        delivery batch.
+        """
+        if not self.batching():
+            return function()
+        cache = self.state().__dict__.setdefault("cache", {})
+        key = (name, user.pk)
+        if key not in cache:
+            cache[key] = function()
+        return cache[key]
+
     def graph_api(self, user):
         """Return an instance of facebook.GraphAPI authorized with the `user`'s
-        OAUth token.
+        OAUth token. Inside a batch the same instance is reused for every post
+        of the user.
         """
-        return user.get_profile().facebook_graph_api()
+        return self.memoize("graph_api", user,
+                lambda: user.get_profile().facebook_graph_api())
 
     def facebook_user_id(self, user):
         """Return the Facebook OpenGraph ID for the user or None if they do not
         have one in the system."""
         if not user:
             return
-        try:
-            user_id = unicode(user.get_profile().facebook_id() or '')
-        except ObjectDoesNotExist:
-            user_id = None
-        return user_id
+        def get_user_id():
+            try:
+                return unicode(user.get_profile().facebook_id() or '')
+            except ObjectDoesNotExist:
+                return None
+        return self.memoize("facebook_user_id", user, get_user_id)
 
     def facebook_token(self, user):
         """Return the Facebook OpenGraph OAuth token for the user or None if
         they do not have one in the system."""
         if not user:
             return
-        return getattr(user.get_profile().facebook_auth(), 'token', None)
+        return self.memoize("facebook_token", user,
+                lambda: getattr(user.get_profile().facebook_auth(), 'token',
+                        None))
 
     def should_send(self, sender, recipient, notice_type, *args, **kwargs):
         """Return true if the sender has an OAuth token and the recipient has at
         least a Facebook OpenGraph ID.
         """
         send = super(FacebookBackend, self).should_send(sender, recipient,
-                notice_type)
+                notice_type, *args, **kwargs)
         return (send and self.facebook_token(sender)
                 and self.facebook_user_id(recipient))
 
+    def prepare(self, sender, recipients, notice_type):
+        """Load the profiles of the sender and all recipients in bulk."""
+        users = list(recipients)
+        if sender:
+            users.append(sender)
+        load_profiles(users)
+
+    def close(self):
+        super(FacebookBackend, self).close()
+        if not self.batching():
+            self.state().cache = {}
+
 
 class FacebookWallPostBackend(FacebookBackend):
     slug = u"facebook_wall_post"
     display_name = u"Facebook Wall Post"
+    io_bound = True
+    formats = ['notice.html']
+    templates = ['wall_post.txt']
 
     def send(self, sender, recipient, notice_type, context, *args, **kwargs):
-        if not self.should_send(sender, recipient, notice_type):
+        """Post to the recipient's wall right away, or inside a delivery batch
+        queue the post to be sent with the sender's other posts as batched
+        Graph API requests of ``NOTIFICATION_FACEBOOK_BATCH_SIZE`` posts.
+        """
+        preferences = kwargs.pop("preferences", None)
+        if not self.should_send(sender, recipient, notice_type,
+                preferences=preferences):
             return False
 
         message = self.render_message(notice_type.label,
                 'wall_post.txt', 'notice.html', context)
+        if self.batching():
+            posts = self.state().__dict__.setdefault("posts", {})
+            pending = posts.setdefault(sender.pk, [])
+            pending.append((sender, recipient, unescape(message),
+                    kwargs.get('attachment', {})))
+            if len(pending) >= FACEBOOK_BATCH_SIZE:
+                self.post_batch(posts.pop(sender.pk))
+            return True
         try:
             graph = self.graph_api(sender)
             graph.put_wall_post(unescape(message),
@@ -67,3 +124,53 @@ class FacebookWallPostBackend(FacebookBackend):
             return False
         else:
             return True
+
+    def post_batch(self, posts):
+        """Send wall posts of a single sender as one batched Graph API
+        request. The posts Facebook rejected, or all of them when the request
+        fails, are reported for their recipients.
+        """
+        sender = posts[0][0]
+        requests = []
+        for _, recipient, message, attachment in posts:
+            body = dict(attachment, message=message)
+            body = dict((key, unicode(value).encode("utf-8"))
+                    for key, value in body.items())
+            requests.append({
+                "method": "POST",
+                "relative_url": "%s/feed" % self.facebook_user_id(recipient),
+                "body": urllib.urlencode(body),
+            })
+        try:
+            responses = self.graph_api(sender).request("", post_args={
+                "batch": simplejson.dumps(requests),
+            })
+        except facebook.GraphAPIError:
+            log.exception("Received an error when making %s wall posts from "
+                    "%s" % (len(posts), sender))
+            exc_info = sys.exc_info()
+            for post in posts:
+                self.report_error(post[1], exc_info)
+            return
+        # a missing response means the post was not made either
+        responses = list(responses or []) + [None] * (len(posts) -
+                len(responses or []))
+        for post, response in zip(posts, responses):
+            if not response or response.get("code") != 200:
+                log.error("Received an error when making a wall post from "
+                        "%s to %s: %r" % (sender, post[1], response))
+                try:
+                    raise WallPostRejected(response)
+                except WallPostRejected:
+                    self.report_error(post[1], sys.exc_info())
+
+    def flush(self):
+        state = self.state()
+        posts = getattr(state, "posts", None)
+        if posts:
+            state.posts = {}
+            for pending in posts.values():
+                self.post_batch(pending)
+
+    def discard(self):
+        self.state().posts = {}
@@ -1,28 +1,54 @@
 from notification.backends.base import NotificationBackend
-from itertools import chain
+from notification.settings import WEB_FLUSH_SIZE
 
 class WebBackend(NotificationBackend):
     slug = u'web'
     display_name = u'Web'
     formats = ['short.txt', 'full.txt']
+    templates = ['notice.html']
 
     def send(self, sender, recipient, notice_type, context, on_site=False,
             *args, **kwargs):
         """Always "sends" (i.e. stores to the database), setting on_site
         accordingly.
+
+        Inside a delivery batch the notices are buffered and written with
+        bulk inserts every ``NOTIFICATION_WEB_FLUSH_SIZE`` notices and when
+        the batch is closed.
         """
         # TODO can't do this at the top or we get circular imports
         from notification.models import Notice
 
-        if not self.should_send(sender, recipient, notice_type):
+        preferences = kwargs.pop("preferences", None)
+        if not self.should_send(sender, recipient, notice_type,
+                preferences=preferences):
             on_site = False
 
-        Notice.objects.create(recipient=recipient,
-                message=self.format_message(notice_type.label,
+        notice = Notice(recipient=recipient,
+                message=self.render_format(notice_type.label,
                         'notice.html', context),
                 notice_type=notice_type,
                 on_site=on_site,
-                data=dict(chain(*([data.iteritems() for data in context]))),
+                data=dict(self.flatten_context(context)),
                 sender=sender,
                 **kwargs)
+        if self.batching():
+            pending = self.state().__dict__.setdefault("notices", [])
+            pending.append(notice)
+            if len(pending) >= WEB_FLUSH_SIZE:
+                self.flush()
+        else:
+            notice.save()
         return True
+
+    def flush(self):
+        from notification.models import Notice
+
+        state = self.state()
+        notices = getattr(state, "notices", None)
+        if notices:
+            state.notices = []
+            Notice.objects.bulk_insert(notices)
+
+    def discard(self):
+        self.state().notices = []
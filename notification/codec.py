@@ -0,0 +1,159 @@
+"""
+Serialization of the notices stored in ``NoticeQueueBatch.pickled_data``.
+
+Encoded batches are prefixed with the version of the codec that wrote them
+(``"2:..."``). Batches without a prefix were written by the original format,
+a base64 encoded pickle, and can still be read.
+
+A batch holds the payload shared by all its recipients once, along with an
+array of recipient ids (see ``pack_notices``). The original layout, a list
+of ``(user id, label, extra_context, on_site, sender, kwargs)`` tuples, is
+still understood by ``unpack_notices``.
+"""
+import zlib
+from array import array
+import base64
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from django.db import models
+from django.contrib.contenttypes.models import ContentType
+
+from notification.settings import BATCH_CODEC
+
+
+class PickleCodec(object):
+    """
+    The original format: a base64 encoded pickle of the notices.
+    """
+    version = None
+
+    def encode(self, data):
+        return pickle.dumps(data).encode("base64")
+
+    def decode(self, value):
+        return pickle.loads(value.decode("base64"))
+
+
+class CompactCodec(object):
+    """
+    A binary pickle compressed with zlib. Saved model instances are stored as
+    ``(content type id, pk)`` references and fetched again when decoding,
+    instead of pickling their whole object graph.
+    """
+    version = "2"
+
+    def persistent_id(self, obj):
+        if isinstance(obj, models.Model) and obj.pk is not None:
+            content_type = ContentType.objects.get_for_model(obj)
+            return (content_type.pk, obj.pk)
+        return None
+
+    def encode(self, data):
+        buf = StringIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistent_id
+        pickler.dump(data)
+        return base64.b64encode(zlib.compress(buf.getvalue()))
+
+    def decode(self, value):
+        instances = {}
+        def persistent_load(reference):
+            # every referenced instance is fetched once per batch; instances
+            # deleted in the meantime are decoded as None
+            if reference not in instances:
+                content_type_id, pk = reference
+                model = ContentType.objects.get_for_id(
+                        content_type_id).model_class()
+                try:
+                    instances[reference] = model._default_manager.get(pk=pk)
+                except model.DoesNotExist:
+                    instances[reference] = None
+            return instances[reference]
+        unpickler = pickle.Unpickler(StringIO(zlib.decompress(
+                base64.b64decode(value))))
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+codecs = {}
+
+
+def register_codec(codec):
+    codecs[codec.version] = codec
+
+register_codec(PickleCodec())
+register_codec(CompactCodec())
+
+
+def encode(data, version=BATCH_CODEC):
+    """
+    Encodes ``data`` with the codec of the given version, by default the one
+    selected by the ``NOTIFICATION_BATCH_CODEC`` setting.
+    """
+    codec = codecs[version]
+    value = codec.encode(data)
+    if codec.version is not None:
+        value = "%s:%s" % (codec.version, value)
+    return value
+
+
+def decode(value):
+    """
+    Decodes a value written by any registered codec.
+    """
+    value = str(value)
+    version, sep, payload = value.partition(":")
+    if not sep:
+        version, payload = None, value
+    return codecs[version].decode(payload)
+
+
+def pack_notices(user_ids, label, extra_context, on_site, sender, kwargs):
+    """
+    Returns the batch layout storing the shared payload once with a compact
+    array of recipient ids.
+    """
+    try:
+        recipients = array("l", user_ids)
+    except (TypeError, OverflowError):
+        recipients = list(user_ids)
+    return {
+        "recipients": recipients,
+        "label": label,
+        "extra_context": extra_context,
+        "on_site": on_site,
+        "sender": sender,
+        "kwargs": kwargs,
+    }
+
+
+def unpack_notices(data):
+    """
+    Yields ``(user ids, label, extra_context, on_site, sender, kwargs)``
+    groups from decoded batch data of either layout. Consecutive tuples of
+    the original layout sharing the same payload objects, as written by
+    ``queue``, are yielded as one group.
+    """
+    if isinstance(data, dict):
+        yield (data["recipients"], data["label"], data["extra_context"],
+                data["on_site"], data["sender"], data["kwargs"])
+        return
+    group = None
+    for user, label, extra_context, on_site, sender, kwargs in data:
+        if (group is not None and group[1] == label and
+                group[2] is extra_context and group[3] == on_site and
+                group[4] is sender and group[5] is kwargs):
+            group[0].append(user)
+            continue
+        if group is not None:
+            yield group
+        group = ([user], label, extra_context, on_site, sender, kwargs)
+    if group is not None:
+        yield group
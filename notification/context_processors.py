@@ -1,10 +1,10 @@
-from notification.models import Notice
+from notification.models import UnseenNoticeCount
 
 
 def notification(request):
     if request.user.is_authenticated():
         return {
-            "notice_unseen_count": Notice.objects.unseen_count_for(request.user, on_site=True),
+            "notice_unseen_count": UnseenNoticeCount.objects.count_for(request.user),
         }
     else:
         return {}
@@ -1,88 +1,620 @@
+import os
 import sys
 import time
+import signal
+import socket
 import logging
+import datetime
 import traceback
+import multiprocessing
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
-from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+from django.core.cache import cache
 from django.core.mail import mail_admins
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 
-from lockfile import FileLock, AlreadyLocked, LockTimeout
-
-from notification.models import NoticeQueueBatch
+from notification.backends import backends, open_backends, close_backends, \
+        flush_backends, discard_backends
+from notification.backends.base import template_cache
+from notification.models import NoticeQueueBatch, NoticeType, FailedNotice, \
+        FailedNoticePayload
+from notification.managers import backoff
 from notification import models as notification
+from notification import codec
+from notification.ratelimit import RateLimiter
+from notification.settings import EMIT_CHUNK_SIZE, ALERT_INTERVAL, \
+        DAEMON_MIN_IDLE, DAEMON_MAX_IDLE, PRIORITIES, INTERLEAVED_BATCHES, \
+        BATCH_LEASE
+from notification.utils import chunked
 
-# lock timeout value. how long to wait for the lock to become available.
-# default behavior is to never wait for the lock to be available.
-LOCK_WAIT_TIMEOUT = getattr(settings, "NOTIFICATION_LOCK_WAIT_TIMEOUT", -1)
 
+class LeaseLost(Exception):
+    pass
+
+
+def worker_name():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+def warm_templates():
+    """
+    Compiles the templates of every backend and notice type up front so the
+    first notices of a run do not pay for the template lookups.
+    """
+    labels = list(NoticeType.objects.values_list("label", flat=True))
+    template_cache.warm(backends, labels)
+
+
+def send_all(worker=None, chunk_size=EMIT_CHUNK_SIZE):
+    """
+    Emits queued batches until none is available. Each batch is leased
+    before it is emitted, so any number of workers on any number of hosts
+    can run send_all at the same time. The batches are interleaved by
+    ``schedule``.
+
+    Returns a dictionary with the number of ``batches`` emitted, the number
+    of notices ``sent``, the number of sends that ``failed`` per backend
+    slug, the number of failed notices ``retried`` and the number of
+    ``seconds`` it took.
+    """
+    if worker is None:
+        worker = worker_name()
 
-def send_all():
-    lock = FileLock("send_notices")
-    
-    logging.debug("acquiring lock...")
-    try:
-        lock.acquire(LOCK_WAIT_TIMEOUT)
-    except AlreadyLocked:
-        logging.debug("lock already in place. quitting.")
-        return
-    except LockTimeout:
-        logging.debug("waiting for the lock timed out. quitting.")
-        return
-    logging.debug("acquired.")
-
-    batches, total_sent = 0, 0
     start_time = time.time()
-    
+    started = datetime.datetime.now()
+
+    batches, total_sent, failed = schedule(worker, chunk_size)
+
+    retried = retry_failed_notices()
+    if FailedNotice.objects.filter(last_failed__gte=started).exists():
+        alert_admins("notices failed", "Some notices could not be sent, see "
+                "the failed_notices management command.")
+
+    stats = {
+        "batches": batches,
+        "sent": total_sent,
+        "failed": failed,
+        "retried": retried,
+        "seconds": time.time() - start_time,
+    }
+    log_stats(stats)
+    return stats
+
+
+def add_counts(total, counts):
+    """
+    Adds the counts of a dictionary to the ones of ``total``.
+    """
+    for key, count in counts.items():
+        total[key] = total.get(key, 0) + count
+    return total
+
+
+def format_failed(failed):
+    return "%s failed%s" % (sum(failed.values()), "".join([" (%s: %s)" % (
+            slug, failed[slug]) for slug in sorted(failed)]))
+
+
+def log_stats(stats):
+    logging.info("")
+    logging.info("%s batches, %s sent, %s, %s failed notices retried" % (
+            stats["batches"], stats["sent"], format_failed(stats["failed"]),
+            stats["retried"]))
+    logging.info("done in %(seconds).2f seconds" % stats)
+    logging.info("template cache: %(hits)s hits, %(misses)s misses" %
+            template_cache.stats())
+
+
+def send_all_worker(chunk_size):
+    stats = send_all(chunk_size=chunk_size)
+    connection.close()
+    return stats
+
+
+def send_all_parallel(workers, chunk_size=EMIT_CHUNK_SIZE):
+    """
+    Runs send_all in ``workers`` forked processes and returns the aggregated
+    statistics. Call it after Django is set up and the templates are warmed
+    so the processes inherit both.
+    """
+    start_time = time.time()
+    # the processes must not share the database connection of the parent
+    connection.close()
+    pool = multiprocessing.Pool(workers)
     try:
-        # nesting the try statement to be Python 2.4
-        for queued_batch in NoticeQueueBatch.objects.order_by('-id'):
-            sent = emit_batch(queued_batch)
-            total_sent += sent
-            if sent > 0:
-                batches +=1
+        results = pool.map(send_all_worker, [chunk_size] * workers)
     finally:
-        logging.debug("releasing lock...")
-        lock.release()
-        logging.debug("released.")
-
+        pool.close()
+        pool.join()
+    stats = {
+        "batches": sum([result["batches"] for result in results]),
+        "sent": sum([result["sent"] for result in results]),
+        "failed": reduce(add_counts, [result["failed"]
+                for result in results], {}),
+        "retried": sum([result["retried"] for result in results]),
+        "seconds": time.time() - start_time,
+    }
     logging.info("")
-    logging.info("%s batches, %s sent" % (batches, sent,))
-    logging.info("done in %.2f seconds" % (time.time() - start_time))
+    logging.info("%s workers" % workers)
+    log_stats(stats)
+    return stats
+
+
+def handle_stop_signals(handler):
+    """
+    Calls ``handler`` on SIGTERM and SIGINT without interrupting the system
+    call in progress, e.g. a send to the mail server.
+    """
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handler)
+        signal.siginterrupt(signum, False)
+
+
+def run_daemon(chunk_size=EMIT_CHUNK_SIZE, min_idle=DAEMON_MIN_IDLE,
+        max_idle=DAEMON_MAX_IDLE):
+    """
+    Emits queued batches until SIGTERM or SIGINT is received, finishing the
+    chunk in progress and handing the batches it holds back to the other
+    workers before returning. When the queue is empty the daemon
+    polls it again after ``min_idle`` seconds, doubling the delay up to
+    ``max_idle`` seconds while it stays empty. The throughput of every loop
+    that emitted something is logged.
+    """
+    stopping = []
+    def stop(signum, frame):
+        logging.info("received signal %s, stopping after the current chunk" %
+                signum)
+        stopping.append(signum)
+    handle_stop_signals(stop)
+
+    worker = worker_name()
+    idle = min_idle
+    logging.info("emitting notices as %s" % worker)
+    while not stopping:
+        start_time = time.time()
+        batches, sent, failed = schedule(worker, chunk_size,
+                stopping=stopping)
+        retried = retry_failed_notices()
+        if batches or retried:
+            seconds = time.time() - start_time
+            logging.info("%s batches, %s sent, %s, %s failed notices retried "
+                    "in %.2f seconds (%.1f notices per second)" % (batches,
+                    sent, format_failed(failed), retried, seconds,
+                    (sent + retried) / max(seconds, 0.001)))
+            idle = min_idle
+        else:
+            # sleep in small steps to stop quickly when asked to
+            wake_at = time.time() + idle
+            while not stopping and time.time() < wake_at:
+                time.sleep(min(0.5, max(wake_at - time.time(), 0)))
+            idle = min(idle * 2, max_idle)
+    connection.close()
+    logging.info("stopped")
+
+
+def run_daemon_parallel(workers, chunk_size=EMIT_CHUNK_SIZE):
+    """
+    Runs ``workers`` daemon processes and forwards SIGTERM and SIGINT to
+    them, returning once they all stopped.
+    """
+    # the processes must not share the database connection of the parent
+    connection.close()
+    processes = [multiprocessing.Process(target=run_daemon,
+            args=(chunk_size,)) for i in xrange(workers)]
+    for process in processes:
+        process.start()
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    # unlike the daemons the parent lets the signals interrupt its waits
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop)
+    for process in processes:
+        # join in steps so the handler runs even where waiting is restarted
+        while process.is_alive():
+            process.join(1)
 
-def emit_batch(queued_batch):
+
+def alert_admins(subject, message):
+    """
+    Mails the admins about failures at most once per
+    NOTIFICATION_ALERT_INTERVAL seconds (across all the workers sharing the
+    cache), with a summary of the notices that failed during the interval.
+    Returns whether the mail was sent.
+    """
+    if not cache.add("notification_alert", True, ALERT_INTERVAL):
+        logging.debug("admins already alerted in the last %s seconds" %
+                ALERT_INTERVAL)
+        return False
+    since = datetime.datetime.now() - datetime.timedelta(
+            seconds=ALERT_INTERVAL)
+    summary = FailedNotice.objects.filter(last_failed__gte=since).values(
+            "label", "backend").annotate(count=Count("id")).order_by()
+    lines = ["%(count)s %(label)s notices failed through %(backend)s" % row
+            for row in summary]
+    if lines:
+        message = "%s\n\nin the last %s seconds:\n%s" % (message,
+                ALERT_INTERVAL, "\n".join(lines))
+    current_site = Site.objects.get_current()
+    mail_admins("[%s emit_notices] %s" % (current_site.name, subject),
+            message, fail_silently=True)
+    return True
+
+
+def format_exception(exc_info):
+    return "".join(traceback.format_exception(*exc_info))
+
+
+def failure_payload(label, extra_context, on_site, sender, kwargs):
+    """
+    Returns an unsaved FailedNoticePayload with what is needed to send a
+    notice again to the recipients it failed for, through the backend each
+    failure is recorded for.
+    """
+    kwargs = dict(kwargs)
+    # the backend is the one of the FailedNotice
+    kwargs.pop("backends", None)
+    return FailedNoticePayload(data=codec.encode(codec.pack_notices([],
+            label, extra_context, on_site, sender, kwargs)))
+
+
+def dead_letter(queued_batch, exception):
+    """
+    Records the recipients a batch was not emitted to yet as FailedNotices,
+    for every backend the batch sends through, and deletes the batch.
+    """
+    def record():
+        data = codec.decode(queued_batch.pickled_data)
+        position = 0
+        for user_ids, label, extra_context, on_site, sender, kwargs in \
+                codec.unpack_notices(data):
+            skip = min(max(queued_batch.progress - position, 0),
+                    len(user_ids))
+            position += len(user_ids)
+            if skip == len(user_ids):
+                continue
+            payload = failure_payload(label, extra_context, on_site, sender,
+                    kwargs)
+            slugs = kwargs.get("backends") or sorted([backend.slug
+                    for backend in backends])
+            for chunk in chunked(user_ids[skip:], EMIT_CHUNK_SIZE):
+                # deleted users are not recorded
+                existing = list(User.objects.filter(pk__in=chunk
+                        ).values_list("pk", flat=True))
+                for slug in slugs:
+                    FailedNotice.objects.record(existing, label, slug,
+                            payload, exception)
+        queued_batch.delete()
+    transaction.commit_on_success(record)()
+
+
+def retry_failed(failed_notices):
+    """
+    Sends failed notices again, one send_now per payload and backend,
+    deleting the ones sent and scheduling the next retry of the others.
+    Returns how many were sent.
+    """
+    groups = {}
+    for failed in failed_notices:
+        groups.setdefault((failed.payload_id, failed.backend), []).append(
+                failed)
+    payloads = FailedNoticePayload.objects.in_bulk([payload_id
+            for payload_id, backend in groups])
     sent = 0
+    for (payload_id, backend), group in groups.items():
+        errors = {}
+        def on_error(backend, recipient, exc_info):
+            errors.setdefault(recipient.pk, exc_info)
+        try:
+            data = codec.decode(payloads[payload_id].data)
+            for user_ids, label, extra_context, on_site, sender, kwargs in \
+                    codec.unpack_notices(data):
+                # recorded before the payloads left the backends out
+                kwargs.pop("backends", None)
+                notification.send_now([failed.recipient for failed in group],
+                        label, extra_context, on_site, sender,
+                        backends=[backend], on_error=on_error, **kwargs)
+        except Exception:
+            exc_info = sys.exc_info()
+            for failed in group:
+                errors.setdefault(failed.recipient_id, exc_info)
+        done = []
+        for failed in group:
+            if failed.recipient_id in errors:
+                logging.warning("retrying %s failed again" % failed)
+                FailedNotice.objects.failed_again(failed,
+                        format_exception(errors[failed.recipient_id]))
+            else:
+                done.append(failed.pk)
+        FailedNotice.objects.filter(pk__in=done).delete()
+        sent += len(done)
+    return sent
+
+
+def retry_failed_notices():
+    """
+    Retries the failed notices that are due and returns how many were sent.
+    """
+    retried = 0
+    while True:
+        due = FailedNotice.objects.due()
+        if not due:
+            break
+        retried += retry_failed([failed for failed in due
+                if FailedNotice.objects.claim(failed)])
+    if retried:
+        FailedNoticePayload.objects.delete_unused()
+    return retried
+
+
+def requeue(user_ids, label, extra_context, on_site, sender, kwargs,
+        countdown):
+    """
+    Queues notices again as a new batch that becomes available to the
+    workers in ``countdown`` seconds.
+    """
+    from notification.tasks import emit_notice_batch
+    notices = codec.pack_notices(user_ids, label, extra_context, on_site,
+            sender, kwargs)
+    batch = NoticeQueueBatch(pickled_data=codec.encode(notices),
+            locked_until=datetime.datetime.now() + datetime.timedelta(
+                    seconds=countdown), priority=PRIORITIES.get(label, 0))
+    batch.save()
+    emit_notice_batch.apply_async((batch.id,), countdown=countdown)
+    return batch
+
+
+def checkpoint(queued_batch, progress, retries, failures):
+    """
+    Makes the work done on a batch durable in a single transaction: saves
+    the batch's progress while renewing its lease, writes the work buffered
+    by the backends that are not I/O-bound (e.g. the notices stored by the
+    web backend), queues the deferred sends (a list of ``requeue``
+    arguments) and records the failed ones (a list of
+    ``FailedNotice.objects.record`` arguments). Raises LeaseLost, writing
+    nothing, if another worker took the batch over.
+    """
+    def save():
+        # checked first, the row stays locked until the commit
+        if not NoticeQueueBatch.objects.renew(queued_batch, progress):
+            raise LeaseLost
+        flush_backends([backend for backend in backends
+                if not backend.io_bound])
+        for args in retries:
+            requeue(*args)
+        for args in failures:
+            FailedNotice.objects.record(*args)
+    transaction.commit_on_success(save)()
+
+
+def renew_leases(active):
+    """
+    Renews the leases of the active batches that are halfway through, so
+    the ones waiting for their turn are not taken over by another worker.
+    Drops the batches whose lease was lost anyway.
+    """
+    renew_before = datetime.datetime.now() + datetime.timedelta(
+            seconds=BATCH_LEASE / 2.0)
+    for entry in active[:]:
+        queued_batch, chunks = entry
+        if queued_batch.locked_until > renew_before:
+            continue
+        if not NoticeQueueBatch.objects.renew(queued_batch):
+            logging.warning("lost the lease of batch %s, leaving it to the "
+                    "worker holding it" % queued_batch.pk)
+            chunks.close()
+            active.remove(entry)
+
+
+def schedule(worker, chunk_size=EMIT_CHUNK_SIZE, width=INTERLEAVED_BATCHES,
+        stopping=()):
+    """
+    Emits queued batches until none is available or ``stopping`` is true,
+    and returns the number of batches emitted, the number of notices sent
+    and the number of sends that failed per backend slug.
+
+    Up to ``width`` batches are claimed at a time and emitted in turns of
+    ``priority + 1`` chunks each (weighted round robin), so a small batch
+    does not wait for a large one to be done. Free slots are refilled with
+    the available batch of highest priority, oldest first, and when all the
+    slots are taken one more batch can be claimed if its priority is higher
+    than the priority of the active ones. The leases of the batches waiting
+    for their turn are renewed along the way. On stop the batches that are
+    not done are released for other workers to go on with.
+    """
+    active = []
+    batches, sent, failed = 0, 0, {}
+    try:
+        while not stopping:
+            while len(active) < width:
+                queued_batch = NoticeQueueBatch.objects.claim(worker)
+                if queued_batch is None:
+                    break
+                active.append((queued_batch, emit_chunks(queued_batch,
+                        chunk_size)))
+            if active and len(active) < 2 * width:
+                # latency sensitive notices do not wait for a free slot
+                lowest = min([batch.priority for batch, chunks in active])
+                queued_batch = NoticeQueueBatch.objects.claim(worker,
+                        above=lowest)
+                if queued_batch is not None:
+                    active.append((queued_batch, emit_chunks(queued_batch,
+                            chunk_size)))
+            if not active:
+                break
+            for entry in active[:]:
+                if entry not in active:
+                    # its lease was lost while it waited
+                    continue
+                queued_batch, chunks = entry
+                for turn in xrange(max(queued_batch.priority, 0) + 1):
+                    renew_leases(active)
+                    if entry not in active:
+                        break
+                    try:
+                        chunk_sent, chunk_failed = chunks.next()
+                    except StopIteration:
+                        active.remove(entry)
+                        batches += 1
+                        break
+                    sent += chunk_sent
+                    add_counts(failed, chunk_failed)
+                    if stopping:
+                        break
+                if stopping:
+                    break
+    finally:
+        for queued_batch, chunks in active:
+            chunks.close()
+            NoticeQueueBatch.objects.release(queued_batch)
+    return batches, sent, failed
+
+
+def emit_batch(queued_batch, chunk_size=EMIT_CHUNK_SIZE):
+    """
+    Emits all the notices of a batch and returns the number of recipients
+    they were sent to.
+    """
+    sent = 0
+    for count, failed in emit_chunks(queued_batch, chunk_size):
+        sent += count
+    return sent
+
+
+def emit_chunks(queued_batch, chunk_size=EMIT_CHUNK_SIZE):
+    """
+    Emits the notices of a batch chunk by chunk, yielding the number of
+    recipients of each chunk once it is emitted along with the number of
+    sends that failed per backend slug. It resumes after the
+    recipients the batch's ``progress`` says were already emitted. The
+    progress is saved after every chunk, so a batch failing half way is not
+    emitted again from the start.
+
+    A send failing for one recipient and backend does not stop the batch,
+    also when the backend only delivers its buffered work on flush: it is
+    recorded as a FailedNotice to be retried later. Sends over a
+    backend's rate limit are moved aside to a batch of their own, available
+    when the limit allows them. When the batch itself fails it is retried
+    after an exponentially growing delay, and after NOTIFICATION_MAX_RETRIES
+    failures its remaining recipients are recorded as FailedNotices.
+    """
     try:
-        notices = pickle.loads(str(queued_batch.pickled_data).decode("base64"))
-        for user, label, extra_context, on_site, sender, kwargs in notices:
-            try:
-                user = User.objects.get(pk=user)
-                logging.info("emitting notice %s to %s" % (label, user))
-                # call this once per user to be atomic and allow for logging to
-                # accurately show how long each takes.
-                notification.send_now([user], label, extra_context,
-                        on_site, sender, **kwargs)
-            except User.DoesNotExist:
-                # Ignore deleted users, just warn about them
-                logging.warning("not emitting notice %s to user %s since it "
-                        "does not exist" % (label, user))
-            sent += 1
+        data = codec.decode(queued_batch.pickled_data)
+        limiter = RateLimiter()
+        failed = {}
+        def on_error(backend, recipient, exc_info):
+            logging.error("sending notice to %s through backend %s failed" % (
+                    recipient, backend.slug), exc_info=exc_info)
+            failed.setdefault((backend.slug, format_exception(exc_info)),
+                    []).append(recipient.pk)
+        # recipients are numbered across all the groups of the batch
+        position = 0
+        # keep the backends' batches open for the whole run so buffered work
+        # (e.g. the notices stored by the web backend) is written in bulk.
+        # The batches interleaved by schedule share these batches, so the
+        # failures are reported to on_error by flushing explicitly.
+        open_backends(backends)
+        try:
+            # the payload shared by the recipients of a group is only
+            # decoded once
+            for user_ids, label, extra_context, on_site, sender, kwargs in \
+                    codec.unpack_notices(data):
+                skip = min(max(queued_batch.progress - position, 0),
+                        len(user_ids))
+                position += skip
+                for chunk in chunked(user_ids[skip:], chunk_size):
+                    # one query per chunk of recipients, and one batched
+                    # send_now call delivering to them
+                    users = User.objects.in_bulk(chunk)
+                    recipients = []
+                    for user_id in chunk:
+                        if user_id in users:
+                            recipients.append(users[user_id])
+                        else:
+                            # Ignore deleted users, just warn about them
+                            logging.warning("not emitting notice %s to user "
+                                    "%s since it does not exist" % (label,
+                                    user_id))
+                    if recipients:
+                        logging.info("emitting notice %s to %s users" % (
+                                label, len(recipients)))
+                        notification.send_now(recipients, label,
+                                extra_context, on_site, sender,
+                                limiter=limiter, on_error=on_error, **kwargs)
+                    position += len(chunk)
+
+                    # deliver the buffered e-mails and posts first: their
+                    # failures are reported to on_error and recorded by the
+                    # checkpoint along with the chunk's progress
+                    flush_backends([backend for backend in backends
+                            if backend.io_bound], on_error)
+                    retries = []
+                    deferred = {}
+                    for user_id, slug in limiter.deferred:
+                        deferred.setdefault(slug, []).append(user_id)
+                    limiter.deferred = []
+                    for slug, retry_ids in deferred.items():
+                        # one batch per burst, each due in its own slot
+                        for ids in chunked(retry_ids,
+                                limiter.burst(slug) or len(retry_ids)):
+                            retries.append((ids, label, extra_context,
+                                    on_site, sender,
+                                    dict(kwargs, backends=[slug]),
+                                    limiter.reserve(slug, len(ids))))
+                    failures = []
+                    failed_counts = {}
+                    if failed:
+                        payload = failure_payload(label, extra_context,
+                                on_site, sender, kwargs)
+                        for (slug, exception), failed_ids in failed.items():
+                            failures.append((failed_ids, label, slug,
+                                    payload, exception))
+                            add_counts(failed_counts, {slug: len(failed_ids)})
+                        failed.clear()
+                    checkpoint(queued_batch, position, retries, failures)
+                    yield len(chunk), failed_counts
+        except:
+            # the work buffered for an interrupted chunk is not delivered:
+            # the chunk is emitted again from the saved progress
+            discard_backends(backends)
+            raise
+        finally:
+            close_backends(backends)
         queued_batch.delete()
+    except LeaseLost:
+        # another worker took the batch over after our lease expired
+        logging.warning("lost the lease of batch %s, leaving it to the "
+                "worker holding it" % queued_batch.pk)
+    except GeneratorExit:
+        # the scheduler stopped before the batch was done
+        raise
     except:
-        # get the exception
-        exc_class, e, t = sys.exc_info()
-        # email people
-        current_site = Site.objects.get_current()
-        subject = "[%s emit_notices] %r" % (current_site.name, e)
-        message = "%s" % ("\n".join(traceback.format_exception(
-            *sys.exc_info())),)
-        mail_admins(subject, message, fail_silently=True)
+        exc_info = sys.exc_info()
         # log it as critical
-        logging.critical("an exception occurred: %r" % e)
-    return sent
+        logging.critical("an exception occurred: %r" % exc_info[1])
+        exception = format_exception(exc_info)
+        pk = queued_batch.pk
+        # hide the batch from the workers for a while
+        if NoticeQueueBatch.objects.failed(queued_batch):
+            alert_admins("%r" % exc_info[1], exception)
+            return
+        # give up on the batch, its recipients are retried one by one
+        try:
+            dead_letter(queued_batch, exception)
+        except Exception:
+            logging.critical("moving batch %s to the failed notices failed" %
+                    pk, exc_info=sys.exc_info())
+            alert_admins("batch %s failed %s times" % (pk,
+                    queued_batch.attempts), "It could not be moved to the "
+                    "failed notices, it is retried every %s seconds.\n\n%s" %
+                    (backoff(queued_batch.attempts), exception))
+            return
+        logging.critical("batch %s failed %s times, moved its remaining "
+                "recipients to the failed notices" % (pk,
+                queued_batch.attempts))
+        alert_admins("batch %s failed %s times" % (pk,
+                queued_batch.attempts), "Its remaining recipients were moved "
+                "to the failed notices.\n\n%s" % exception)
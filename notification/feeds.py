@@ -10,6 +10,7 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 
 from notification.models import Notice
+from notification.utils import notice_cursor, parse_cursor
 from notification.atomformat import Feed
 
 
@@ -47,7 +48,18 @@ class BaseNoticeFeed(Feed):
 
 class NoticeUserFeed(BaseNoticeFeed):
     
+    # cursor of the last notice of the previous page, see items
+    cursor = None
+    # the notices of the page and the first one of the next page, see page
+    notices = None
+    
     def get_object(self, params):
+        if len(params) > 1:
+            try:
+                parse_cursor(params[1])
+            except ValueError:
+                raise LookupError("invalid cursor %r" % params[1])
+            self.cursor = params[1]
         return get_object_or_404(User, username=params[0].lower())
     
     def feed_id(self, user):
@@ -75,7 +87,35 @@ class NoticeUserFeed(BaseNoticeFeed):
             Site.objects.get_current().domain,
             reverse("notification_notices"),
         )
-        return ({"href": complete_url},)
+        links = [{"href": complete_url}]
+        notices = self.page(user)
+        if len(notices) > ITEMS_PER_FEED:
+            # the older notices follow the cursor of the last one shown
+            links.append({
+                "href": "%s://%s%s?before=%s" % (
+                    DEFAULT_HTTP_PROTOCOL,
+                    Site.objects.get_current().domain,
+                    reverse("notification_feed_for_user"),
+                    notice_cursor(notices[ITEMS_PER_FEED - 1]),
+                ),
+                "rel": "next",
+            })
+        return links
+    
+    def page(self, user):
+        """
+        The notices of the page with one more, telling whether an older page
+        follows. They are fetched once for the links and the items.
+        """
+        if self.notices is None:
+            self.notices = list(Notice.objects.notices_for(user,
+                    before=self.cursor)[:ITEMS_PER_FEED + 1])
+        return self.notices
     
     def items(self, user):
-        return Notice.objects.notices_for(user).order_by("-added")[:ITEMS_PER_FEED]
+        """
+        The newest notices, or the ones older than the cursor given after
+        the username, taken from the ``before`` query parameter of the feed
+        URL.
+        """
+        return self.page(user)[:ITEMS_PER_FEED]
@@ -0,0 +1,40 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from notification import codec
+
+
+class Command(NoArgsCommand):
+    help = ("Compare the size and encode/decode speed of the notice batch "
+            "codecs on a synthetic batch.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--recipients", type="int", default=10000,
+            help="Number of recipients in the synthetic batch."),
+        make_option("--repeat", type="int", default=5,
+            help="Number of timed runs per codec, the best is reported."),
+    )
+
+    def handle_noargs(self, **options):
+        extra_context = {
+            "title": u"A notice title",
+            "body": u"Lorem ipsum dolor sit amet. " * 20,
+            "tags": [u"tag%s" % i for i in xrange(20)],
+        }
+        notices = [(user_id, "benchmark", extra_context, True, None, {})
+                for user_id in xrange(options["recipients"])]
+        print "%-10s %12s %12s %12s" % ("codec", "size", "encode (s)",
+                "decode (s)")
+        for version, instance in sorted(codec.codecs.items()):
+            encode_times, decode_times = [], []
+            for i in xrange(options["repeat"]):
+                start = time.time()
+                value = codec.encode(notices, version)
+                encode_times.append(time.time() - start)
+                start = time.time()
+                codec.decode(value)
+                decode_times.append(time.time() - start)
+            print "%-10s %12d %12.4f %12.4f" % (
+                    instance.__class__.__name__, len(value),
+                    min(encode_times), min(decode_times))
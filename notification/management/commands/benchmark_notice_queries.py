@@ -0,0 +1,100 @@
+import time
+import random
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.contrib.auth.models import User
+
+from notification.models import Notice, NoticeType, ObservedItem
+
+
+class Command(NoArgsCommand):
+    help = ("Show the query plans and timings of the notice queries for a "
+            "benchmark user. Run it before and after migrating to compare. "
+            "Use --seed to create the benchmark data first.")
+    option_list = NoArgsCommand.option_list + (
+        make_option("--seed", type="int", default=0,
+            help="Number of notices to create for the benchmark users "
+                "before running the queries."),
+        make_option("--users", type="int", default=100,
+            help="Number of benchmark users the seeded notices are spread "
+                "over."),
+        make_option("--repeat", type="int", default=10,
+            help="Number of timed runs per query, the best is reported."),
+        make_option("--database", default=DEFAULT_DB_ALIAS,
+            help="Database to run the queries on."),
+    )
+
+    def handle_noargs(self, **options):
+        if options["seed"]:
+            self.seed(options["seed"], options["users"])
+        try:
+            user = User.objects.get(username="notification-benchmark-0")
+        except User.DoesNotExist:
+            print "no benchmark data, run the command with --seed first"
+            return
+        database = options["database"]
+        queries = [
+            ("inbox", Notice.objects.notices_for(user, on_site=True)[:50]),
+            ("unseen count", Notice.objects.notices_for(user, unseen=True,
+                    on_site=True)),
+            ("feed", Notice.objects.notices_for(user)[:50]),
+            ("sent", Notice.objects.sent(user)[:50]),
+            ("observers", ObservedItem.objects.filter(content_type__pk=1,
+                    object_id=1, signal="post_save")),
+        ]
+        for name, queryset in queries:
+            queryset = queryset.using(database)
+            if name == "unseen count":
+                run = queryset.count
+            else:
+                run = lambda: list(queryset)
+            times = []
+            for i in xrange(options["repeat"]):
+                start = time.time()
+                run()
+                times.append(time.time() - start)
+            print "%s: %.2f ms" % (name, min(times) * 1000)
+            for row in self.explain(queryset, database):
+                print "    %s" % " ".join([unicode(column) for column in row])
+
+    def explain(self, queryset, database):
+        connection = connections[database]
+        sql, params = queryset.query.get_compiler(database).as_sql()
+        if connection.vendor == "sqlite":
+            sql = "EXPLAIN QUERY PLAN " + sql
+        else:
+            sql = "EXPLAIN " + sql
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def seed(self, count, users):
+        notice_type, created = NoticeType.objects.get_or_create(
+                label="notification-benchmark", defaults={
+                    "display": "Benchmark", "description": "Benchmark notice",
+                    "default": 0})
+        recipients = []
+        for i in xrange(users):
+            user, created = User.objects.get_or_create(
+                    username="notification-benchmark-%s" % i)
+            recipients.append(user)
+        now = datetime.datetime.now()
+        notices = []
+        for i in xrange(count):
+            notices.append(Notice(recipient=random.choice(recipients),
+                    sender=random.choice(recipients),
+                    message=u"Benchmark notice %s" % i,
+                    notice_type=notice_type,
+                    added=now - datetime.timedelta(
+                            seconds=random.randint(0, 365 * 86400)),
+                    unseen=random.random() < 0.1,
+                    archived=random.random() < 0.2,
+                    on_site=random.random() < 0.9))
+            if len(notices) == 10000:
+                Notice.objects.bulk_insert(notices)
+                notices = []
+        Notice.objects.bulk_insert(notices)
+        print "created %s notices for %s users" % (count, users)
@@ -0,0 +1,26 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from notification.models import Notice
+from notification.settings import PURGE_CHUNK_SIZE, PURGE_DELAY
+
+
+class Command(NoArgsCommand):
+    help = "Delete the obsolete notices in chunks."
+    option_list = NoArgsCommand.option_list + (
+        make_option("--chunk-size", type="int", dest="chunk_size",
+            default=PURGE_CHUNK_SIZE,
+            help="Number of notices deleted per query."),
+        make_option("--delay", type="float", default=PURGE_DELAY,
+            help="Number of seconds to wait between chunks."),
+    )
+
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        def progress(deleted, last):
+            logging.info("%s deleted, up to id %s" % (deleted, last))
+        deleted = Notice.objects.delete_obsolete_notices(
+                options["chunk_size"], options["delay"], progress)
+        logging.info("done, %s obsolete notices deleted" % deleted)
@@ -1,13 +1,35 @@
 import logging
+from optparse import make_option
 
 from django.core.management.base import NoArgsCommand
 
-from notification.engine import send_all
+from notification.engine import send_all, send_all_parallel, warm_templates, \
+        run_daemon, run_daemon_parallel
+from notification.settings import EMIT_CHUNK_SIZE
 
 class Command(NoArgsCommand):
     help = "Emit queued notices."
+    option_list = NoArgsCommand.option_list + (
+        make_option("--workers", type="int", default=1,
+            help="Number of worker processes emitting batches in parallel."),
+        make_option("--batch-chunk", type="int", dest="batch_chunk",
+            default=EMIT_CHUNK_SIZE,
+            help="Number of recipients of a batch sent to at once."),
+        make_option("--daemon", action="store_true", default=False,
+            help="Keep running and emit notices as they are queued until "
+                "SIGTERM or SIGINT is received."),
+    )
     
     def handle_noargs(self, **options):
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
         logging.info("-" * 72)
-        send_all()
+        warm_templates()
+        if options["daemon"]:
+            if options["workers"] > 1:
+                run_daemon_parallel(options["workers"], options["batch_chunk"])
+            else:
+                run_daemon(options["batch_chunk"])
+        elif options["workers"] > 1:
+            send_all_parallel(options["workers"], options["batch_chunk"])
+        else:
+            send_all(chunk_size=options["batch_chunk"])
@@ -0,0 +1,54 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from notification.engine import retry_failed
+from notification.models import FailedNotice, FailedNoticePayload
+from notification.utils import chunked
+
+
+class Command(BaseCommand):
+    args = "[failed notice id ...]"
+    help = ("List, replay or delete the notices that could not be sent. "
+            "Acts on all failed notices unless ids are given.")
+    option_list = BaseCommand.option_list + (
+        make_option("--replay", action="store_true", default=False,
+            help="Send the failed notices again right away."),
+        make_option("--delete", action="store_true", default=False,
+            help="Delete the failed notices."),
+        make_option("--traceback-of", type="int", dest="traceback_of",
+            help="Show the exception of the given failed notice."),
+    )
+
+    def handle(self, *ids, **options):
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        failed_notices = FailedNotice.objects.select_related("recipient")
+        if ids:
+            failed_notices = failed_notices.filter(pk__in=ids)
+        if options["traceback_of"]:
+            print FailedNotice.objects.get(
+                    pk=options["traceback_of"]).exception
+        elif options["delete"]:
+            count = failed_notices.count()
+            failed_notices.delete()
+            FailedNoticePayload.objects.delete_unused()
+            print "deleted %s failed notices" % count
+        elif options["replay"]:
+            sent, count = 0, 0
+            # the notices sharing a payload are sent together
+            for chunk in chunked(failed_notices.iterator(), 100):
+                sent += retry_failed(chunk)
+                count += len(chunk)
+            FailedNoticePayload.objects.delete_unused()
+            print "%s sent, %s failed again" % (sent, count - sent)
+        else:
+            for failed_notice in failed_notices:
+                if failed_notice.next_retry is None:
+                    next_retry = "no more retries"
+                else:
+                    next_retry = "next retry %s" % failed_notice.next_retry
+                print "%s: %s, failed %s times, last at %s, %s" % (
+                        failed_notice.pk, failed_notice,
+                        failed_notice.retries + 1, failed_notice.last_failed,
+                        next_retry)
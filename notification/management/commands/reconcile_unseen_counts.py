@@ -0,0 +1,14 @@
+import logging
+
+from django.core.management.base import NoArgsCommand
+
+from notification.models import UnseenNoticeCount
+
+
+class Command(NoArgsCommand):
+    help = "Count the unseen notices of every user again and fix the counters that drifted."
+
+    def handle_noargs(self, **options):
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        fixed = UnseenNoticeCount.objects.reconcile()
+        logging.info("%s unseen counts fixed" % fixed)
@@ -1,9 +1,24 @@
+import time
 import datetime
 
-from django.db import models
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models.sql import DeleteQuery
+from django.db.models import Q, F, Count, Max
 from django.contrib.contenttypes.models import ContentType
 
-from .settings import OBSOLETE_DAYS
+from .settings import OBSOLETE_DAYS, PREFERENCE_CHUNK_SIZE, INSERT_CHUNK_SIZE, \
+        BATCH_LEASE, SKIP_LOCKED, RETRY_DELAY, MAX_RETRY_DELAY, MAX_RETRIES, \
+        PAGE_SIZE, OBSOLETE_DAYS_BY_TYPE, PURGE_CHUNK_SIZE, PURGE_DELAY
+from .utils import notice_cursor, parse_cursor, insert_many, in_transaction, \
+        chunked
+
+
+def backoff(attempts):
+    """
+    returns the number of seconds to wait before retrying something that
+    failed ``attempts`` times.
+    """
+    return min(RETRY_DELAY * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY)
 
 
 class NoticeSettingManager(models.Manager):
@@ -22,13 +37,72 @@ class NoticeSettingManager(models.Manager):
                                   send=default)
             return setting, True
 
+    def settings_for(self, users, notice_type, backends):
+        """
+        returns a dictionary mapping ``(user id, backend path)`` to the
+        ``send`` flag of every given active user and backend for
+        ``notice_type``.
+
+        Settings are loaded with chunked ``IN`` queries and the missing ones
+        are created in bulk with their default value. Inactive users are
+        left out: no backend sends to them.
+        """
+        user_ids = [user.pk for user in users if user.is_active]
+        paths = dict((backend.path(), backend) for backend in backends)
+        preferences = {}
+        for i in xrange(0, len(user_ids), PREFERENCE_CHUNK_SIZE):
+            preferences.update(self.stored_settings(notice_type,
+                    user_ids[i:i + PREFERENCE_CHUNK_SIZE], paths.keys()))
+        missing = []
+        for user_id in user_ids:
+            for path, backend in paths.iteritems():
+                if (user_id, path) not in preferences:
+                    default = backend.sensitivity <= notice_type.default
+                    preferences[(user_id, path)] = default
+                    missing.append(self.model(user_id=user_id,
+                            notice_type=notice_type, backend=path,
+                            send=default))
+        for i in xrange(0, len(missing), INSERT_CHUNK_SIZE):
+            chunk = missing[i:i + INSERT_CHUNK_SIZE]
+            sid = transaction.savepoint(using=self.db)
+            try:
+                insert_many(self, chunk)
+                transaction.savepoint_commit(sid, using=self.db)
+            except IntegrityError:
+                # a concurrent send created some of these settings: use the
+                # stored ones and only create the others
+                transaction.savepoint_rollback(sid, using=self.db)
+                stored = self.stored_settings(notice_type,
+                        [setting.user_id for setting in chunk], paths.keys())
+                preferences.update(stored)
+                for setting in chunk:
+                    if (setting.user_id, setting.backend) in stored:
+                        continue
+                    sid = transaction.savepoint(using=self.db)
+                    try:
+                        setting.save(force_insert=True)
+                        transaction.savepoint_commit(sid, using=self.db)
+                    except IntegrityError:
+                        transaction.savepoint_rollback(sid, using=self.db)
+        return preferences
+
+    def stored_settings(self, notice_type, user_ids, paths):
+        """
+        returns the ``send`` flag of the stored settings of the given users
+        and backend paths for ``notice_type``, keyed by ``(user id, backend
+        path)``.
+        """
+        rows = self.filter(notice_type=notice_type, user__in=user_ids,
+                backend__in=paths).values_list("user", "backend", "send")
+        return dict(((user_id, path), send) for user_id, path, send in rows)
+
 
 class NoticeManager(models.Manager):
 
     def notices_for(self, user, archived=False, unseen=None, on_site=None,
-                    sent=False):
+                    sent=False, before=None, after=None):
         """
-        returns Notice objects for the given user.
+        returns Notice objects for the given user, newest first.
 
         If archived=False, it only include notices not archived.
         If archived=True, it returns all notices for that user.
@@ -36,6 +110,11 @@ class NoticeManager(models.Manager):
         If unseen=None, it includes all notices.
         If unseen=True, return only unseen notices.
         If unseen=False, return only seen notices.
+
+        If before is a cursor (see notification.utils.notice_cursor), return
+        only the notices older than the cursor.
+        If after is a cursor, return only the notices newer than the cursor,
+        oldest first.
         """
         if sent:
             lookup_kwargs = {"sender": user}
@@ -48,8 +127,107 @@ class NoticeManager(models.Manager):
             qs = qs.filter(unseen=unseen)
         if on_site is not None:
             qs = qs.filter(on_site=on_site)
+        # keyset pagination: the position of a notice is (added, id), so
+        # any page is read from the index without skipping rows
+        if before is not None:
+            qs = self.past_cursor(qs, before, "<")
+        if after is not None:
+            qs = self.past_cursor(qs, after, ">")
+            qs = qs.order_by("added", "id")
+        else:
+            qs = qs.order_by("-added", "-id")
         return qs.select_related('notice_type')
 
+    def past_cursor(self, qs, cursor, direction):
+        """
+        returns the notices of ``qs`` older (``direction`` "<") or newer
+        (">") than the cursor. On PostgreSQL the (added, id) row is compared
+        as a whole, which is read from the index as a single range.
+        """
+        added, pk = parse_cursor(cursor)
+        if connection.vendor == "postgresql":
+            table = connection.ops.quote_name(self.model._meta.db_table)
+            return qs.extra(where=["(%s.added, %s.id) %s (%%s, %%s)" % (
+                    table, table, direction)], params=[added, pk])
+        if direction == "<":
+            return qs.filter(Q(added__lt=added) | Q(added=added, pk__lt=pk))
+        return qs.filter(Q(added__gt=added) | Q(added=added, pk__gt=pk))
+
+    def page_for(self, user, before=None, after=None, size=PAGE_SIZE,
+            **kwargs):
+        """
+        returns a page of at most ``size`` notices for the given user, newest
+        first, with the cursor of the next (older) page and of the previous
+        (newer) page, or None where there is no such page. The page starts
+        after the ``before`` cursor or ends before the ``after`` cursor, and
+        is the newest page without either. Other arguments are passed to
+        notices_for.
+        """
+        if after is not None:
+            notices = list(self.notices_for(user, after=after,
+                    **kwargs)[:size + 1])
+            if len(notices) > size:
+                notices = notices[:size]
+                notices.reverse()
+                return (notices, notice_cursor(notices[-1]),
+                        notice_cursor(notices[0]))
+            # there are not enough newer notices for a page of their own
+            before = None
+        notices = list(self.notices_for(user, before=before,
+                **kwargs)[:size + 1])
+        next_cursor, prev_cursor = None, None
+        if len(notices) > size:
+            notices = notices[:size]
+            next_cursor = notice_cursor(notices[-1])
+        if before is not None and notices:
+            prev_cursor = notice_cursor(notices[0])
+        return notices, next_cursor, prev_cursor
+
+    def bulk_insert(self, notices):
+        """
+        inserts the given unsaved Notice objects with chunked bulk inserts
+        inside a single transaction, or inside the caller's one.
+        """
+        from notification.models import UnseenNoticeCount
+
+        deltas = {}
+        for notice in notices:
+            if notice.counts_as_unseen():
+                deltas[notice.recipient_id] = deltas.get(
+                        notice.recipient_id, 0) + 1
+        def insert():
+            insert_many(self, notices)
+            UnseenNoticeCount.objects.adjust(deltas)
+        in_transaction(insert, self.db)
+
+    def mark_seen(self, pks):
+        """
+        marks the notices with the given primary keys seen with a single
+        update.
+        """
+        from notification.models import UnseenNoticeCount
+
+        def mark():
+            unseen = self.filter(pk__in=pks, unseen=True)
+            deltas = {}
+            for recipient_id in unseen.filter(on_site=True,
+                    archived=False).values_list("recipient", flat=True):
+                deltas[recipient_id] = deltas.get(recipient_id, 0) - 1
+            unseen.update(unseen=False)
+            UnseenNoticeCount.objects.adjust(deltas)
+        in_transaction(mark, self.db)
+
+    def mark_all_seen(self, recipient):
+        """
+        marks all the notices of the given user seen.
+        """
+        from notification.models import UnseenNoticeCount
+
+        def mark():
+            self.notices_for(recipient, unseen=True).update(unseen=False)
+            UnseenNoticeCount.objects.filter(pk=recipient.pk).update(count=0)
+        in_transaction(mark, self.db)
+
     def unseen_count_for(self, recipient, **kwargs):
         """
         returns the number of unseen notices for the given user but does not
@@ -72,17 +250,292 @@ class NoticeManager(models.Manager):
         return self.notices_for(sender, **kwargs)
 
     def get_obsolete_notices(self):
-        d = datetime.datetime.now() - datetime.timedelta(days=OBSOLETE_DAYS)
-        query = self.exclude(unseen=True).filter(added__lt=d)
-        return query
+        """
+        returns the seen notices older than NOTIFICATION_OBSOLETE_DAYS days,
+        or than the number of days NOTIFICATION_OBSOLETE_DAYS_BY_TYPE gives
+        for their notice type label (None keeps them).
+        """
+        from notification.models import NoticeType
+
+        now = datetime.datetime.now()
+        obsolete = Q(added__lt=now - datetime.timedelta(days=OBSOLETE_DAYS))
+        # filter on the notice type ids so the query needs no join
+        overrides = list(NoticeType.objects.filter(
+                label__in=OBSOLETE_DAYS_BY_TYPE.keys()).values_list("label",
+                "pk"))
+        if overrides:
+            obsolete &= ~Q(notice_type__in=[pk for label, pk in overrides])
+            for label, pk in overrides:
+                days = OBSOLETE_DAYS_BY_TYPE[label]
+                if days is not None:
+                    obsolete |= Q(notice_type=pk,
+                            added__lt=now - datetime.timedelta(days=days))
+        return self.exclude(unseen=True).filter(obsolete)
+
+    def delete_obsolete_notices(self, chunk_size=PURGE_CHUNK_SIZE,
+            delay=PURGE_DELAY, progress=None):
+        """
+        deletes the obsolete notices and returns their number.
 
-    def delete_obsolete_notices(self):
+        They are deleted without loading them, one DELETE per range of
+        primary keys holding ``chunk_size`` obsolete notices, each in its own
+        transaction and followed by a pause of ``delay`` seconds so the purge
+        neither holds locks for long nor saturates the database. The number
+        of notices deleted so far and the last primary key deleted are
+        passed to ``progress`` after each chunk.
+        """
         query = self.get_obsolete_notices()
-        deleted = 0
-        for p in query.iterator():
-            p.delete()
-            deleted += 1
-        return deleted
+        total, last = 0, 0
+        while True:
+            remaining = query.filter(pk__gt=last)
+            bound = list(remaining.order_by("pk").values_list("pk",
+                    flat=True)[chunk_size - 1:chunk_size])
+            if bound:
+                chunk, end = remaining.filter(pk__lte=bound[0]), bound[0]
+            else:
+                # the last chunk, ending at the highest obsolete primary key
+                chunk = remaining
+                end = remaining.aggregate(end=Max("pk"))["end"]
+            def delete():
+                # a set based DELETE: no signals are sent for obsolete
+                # notices and nothing cascades from them; being seen, they
+                # are not in the unseen counts either
+                cursor = chunk.query.clone(DeleteQuery).get_compiler(
+                        self.db).execute_sql(None)
+                return cursor.rowcount
+            total += transaction.commit_on_success(delete)()
+            if end is not None:
+                last = end
+                if progress is not None:
+                    progress(total, last)
+            if not bound:
+                break
+            if delay:
+                time.sleep(delay)
+        return total
+
+
+class UnseenNoticeCountManager(models.Manager):
+
+    def count_for(self, user):
+        """
+        returns the number of unseen notices shown on site to the given user,
+        counting them once for the users who have no counter yet.
+        """
+        try:
+            return self.get(pk=user.pk).count
+        except self.model.DoesNotExist:
+            from notification.models import Notice
+
+            count = Notice.objects.unseen_count_for(user, on_site=True)
+            counter, created = self.get_or_create(user=user,
+                    defaults={"count": count})
+            return counter.count
+
+    def adjust(self, deltas):
+        """
+        adds the given deltas to the counters of the users they are keyed by.
+        Users without a counter are skipped: theirs is counted from the
+        notices when it is first read.
+        """
+        users = {}
+        for user_id, delta in deltas.iteritems():
+            if delta:
+                users.setdefault(delta, []).append(user_id)
+        for delta, user_ids in users.iteritems():
+            self.filter(pk__in=user_ids).update(count=F("count") + delta)
+
+    def reconcile(self, chunk_size=PREFERENCE_CHUNK_SIZE):
+        """
+        counts the unseen notices of every user with a counter again and
+        fixes the counters that drifted. Returns the number of counters
+        fixed.
+        """
+        from notification.models import Notice
+        from notification.utils import chunked, iter_pks
+
+        fixed = 0
+        for user_ids in chunked(iter_pks(self.all(), chunk_size), chunk_size):
+            counts = dict(Notice.objects.filter(recipient__in=user_ids,
+                    unseen=True, on_site=True, archived=False).values_list(
+                    "recipient").annotate(Count("id")).order_by())
+            for user_id, count in self.filter(pk__in=user_ids).values_list(
+                    "pk", "count"):
+                actual = counts.get(user_id, 0)
+                if count != actual:
+                    self.filter(pk=user_id).update(count=actual)
+                    fixed += 1
+        return fixed
+
+
+class NoticeQueueBatchManager(models.Manager):
+
+    def available(self, now=None):
+        """
+        returns the batches that are not leased or whose lease expired.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        return self.filter(Q(locked_until__isnull=True) |
+                Q(locked_until__lt=now))
+
+    def candidates(self, now, limit, above=None):
+        """
+        returns the ids of up to ``limit`` available batches, the ones with
+        the highest priority first and the oldest first among those. With
+        ``above`` only batches with a higher priority are returned. With
+        NOTIFICATION_SKIP_LOCKED on PostgreSQL the rows are locked with
+        ``FOR UPDATE SKIP LOCKED`` so concurrent workers get different ones.
+        """
+        if SKIP_LOCKED and connection.vendor == "postgresql":
+            where, params = "", [now]
+            if above is not None:
+                where, params = " AND priority > %s", [now, above]
+            cursor = connection.cursor()
+            cursor.execute("SELECT id FROM %s WHERE (locked_until IS NULL OR "
+                    "locked_until < %%s)%s ORDER BY priority DESC, id LIMIT "
+                    "%%s FOR UPDATE SKIP LOCKED" % (connection.ops.quote_name(
+                    self.model._meta.db_table), where), params + [limit])
+            return [row[0] for row in cursor.fetchall()]
+        batches = self.available(now)
+        if above is not None:
+            batches = batches.filter(priority__gt=above)
+        return list(batches.order_by("-priority", "id").values_list("pk",
+                flat=True)[:limit])
+
+    def claim(self, worker, pk=None, lease=BATCH_LEASE, above=None):
+        """
+        atomically leases an available batch (the given one if ``pk`` is
+        passed, else the first of the ``candidates``) to ``worker`` for
+        ``lease`` seconds and returns it, or returns None if there is none.
+        Batches whose worker crashed become available again once their lease
+        expired.
+        """
+        def claim():
+            now = datetime.datetime.now()
+            if pk is None:
+                candidates = self.candidates(now, 10, above)
+            else:
+                candidates = [pk]
+            for candidate in candidates:
+                # the conditional update only succeeds for one worker
+                claimed = self.available(now).filter(pk=candidate).update(
+                        locked_until=now + datetime.timedelta(seconds=lease),
+                        locked_by=worker)
+                if claimed:
+                    return candidate
+        claimed = transaction.commit_on_success(claim)()
+        if claimed is not None:
+            return self.get(pk=claimed)
+
+    def renew(self, batch, progress=None, lease=BATCH_LEASE):
+        """
+        extends the lease of a batch still held by its worker, saving its
+        ``progress`` if given, and returns whether it is still held.
+        """
+        values = {
+            "locked_until": datetime.datetime.now() + datetime.timedelta(
+                    seconds=lease),
+        }
+        if progress is not None:
+            values["progress"] = progress
+        renewed = self.filter(pk=batch.pk, locked_by=batch.locked_by).update(
+                **values)
+        if renewed:
+            for name, value in values.items():
+                setattr(batch, name, value)
+        return bool(renewed)
+
+    def release(self, batch):
+        """
+        ends the lease of a batch still held by its worker so another worker
+        can go on emitting it right away.
+        """
+        self.filter(pk=batch.pk, locked_by=batch.locked_by).update(
+                locked_until=None)
+
+    def failed(self, batch):
+        """
+        records that emitting ``batch`` failed and hides it from the workers
+        for an exponentially growing delay. Returns whether it is to be
+        retried, i.e. it failed less than NOTIFICATION_MAX_RETRIES times.
+        """
+        attempts = batch.attempts + 1
+        self.filter(pk=batch.pk).update(attempts=attempts,
+                locked_until=datetime.datetime.now() + datetime.timedelta(
+                        seconds=backoff(attempts)))
+        batch.attempts = attempts
+        return attempts < MAX_RETRIES
+
+
+class FailedNoticeManager(models.Manager):
+
+    def record(self, user_ids, label, backend, payload, exception):
+        """
+        records the failure of a notice sent to the given users through the
+        backend with the given slug. ``payload`` is the FailedNoticePayload
+        to send the notice again, saved first if it is new, so the failures
+        of a notice can share it.
+        """
+        if payload.pk is None:
+            payload.save()
+        now = datetime.datetime.now()
+        next_retry = now + datetime.timedelta(seconds=backoff(1))
+        failed = [self.model(recipient_id=user_id, label=label,
+                backend=backend, payload_id=payload.pk, exception=exception,
+                retries=0, next_retry=next_retry, added=now, last_failed=now)
+                for user_id in user_ids]
+        insert_many(self, failed)
+
+    def due(self, limit=100):
+        """
+        returns up to ``limit`` failed notices whose retry is due.
+        """
+        return list(self.filter(next_retry__lte=datetime.datetime.now(),
+                ).select_related("recipient").order_by("next_retry")[:limit])
+
+    def claim(self, failed):
+        """
+        hides a failed notice from the other workers while it is retried and
+        returns whether it was still available.
+        """
+        next_retry = datetime.datetime.now() + datetime.timedelta(
+                seconds=BATCH_LEASE)
+        claimed = self.filter(pk=failed.pk,
+                next_retry=failed.next_retry).update(next_retry=next_retry)
+        if claimed:
+            failed.next_retry = next_retry
+        return bool(claimed)
+
+    def failed_again(self, failed, exception):
+        """
+        records another failure of ``failed``, scheduling the next retry
+        unless it failed NOTIFICATION_MAX_RETRIES times.
+        """
+        now = datetime.datetime.now()
+        failed.retries += 1
+        failed.exception = exception
+        failed.last_failed = now
+        if failed.retries >= MAX_RETRIES:
+            failed.next_retry = None
+        else:
+            failed.next_retry = now + datetime.timedelta(
+                    seconds=backoff(failed.retries + 1))
+        failed.save()
+
+
+class FailedNoticePayloadManager(models.Manager):
+
+    def delete_unused(self):
+        """
+        deletes the payloads no failed notice refers to anymore and returns
+        how many there were.
+        """
+        unused = list(self.filter(failed_notices__isnull=True).values_list(
+                "pk", flat=True))
+        for chunk in chunked(unused, INSERT_CHUNK_SIZE):
+            self.filter(pk__in=chunk).delete()
+        return len(unused)
 
 
 class ObservedItemManager(models.Manager):
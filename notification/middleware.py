@@ -0,0 +1,16 @@
+from notification.models import defer_seen_notices, flush_seen_notices
+
+
+class SeenNoticesMiddleware(object):
+    """
+    Marks the notices shown during a request seen with a single update once
+    the response is rendered, instead of one update per notice for which
+    the templates called Notice.is_unseen.
+    """
+    
+    def process_request(self, request):
+        defer_seen_notices()
+    
+    def process_response(self, request, response):
+        flush_seen_notices()
+        return response
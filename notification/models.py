@@ -1,4 +1,6 @@
 import datetime
+import threading
+from itertools import groupby
 
 import base64
 try:
@@ -23,10 +25,17 @@ from django.contrib.auth.models import AnonymousUser
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 
-from notification.backends import backend_field_choices, backends
+from notification.backends import backend_field_choices, backends, \
+        open_backends, close_backends
 
-from .settings import QUEUE_ALL
-from .managers import NoticeSettingManager, NoticeManager, ObservedItemManager
+from .settings import QUEUE_ALL, PREFERENCE_CHUNK_SIZE, CONCURRENT_BACKENDS, \
+        QUEUE_BATCH_SIZE, PRIORITIES
+from .managers import NoticeSettingManager, NoticeManager, ObservedItemManager, \
+        NoticeQueueBatchManager, FailedNoticeManager, UnseenNoticeCountManager, \
+        FailedNoticePayloadManager
+from .pool import BackendPool, PendingSend
+from notification import codec
+from notification.utils import chunked, iter_pks
 
 
 class LanguageStoreNotAvailable(Exception):
@@ -126,24 +135,65 @@ class Notice(models.Model):
     def __unicode__(self):
         return self.message
 
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        super(Notice, self).save(*args, **kwargs)
+        if created and self.counts_as_unseen():
+            UnseenNoticeCount.objects.adjust({self.recipient_id: 1})
+
+    def delete(self, *args, **kwargs):
+        if self.counts_as_unseen():
+            UnseenNoticeCount.objects.adjust({self.recipient_id: -1})
+        super(Notice, self).delete(*args, **kwargs)
+
+    def counts_as_unseen(self):
+        """
+        returns whether the notice is counted in the unseen count of its
+        recipient.
+        """
+        return self.unseen and self.on_site and not self.archived
+
     def archive(self):
+        counted = self.counts_as_unseen()
         self.archived = True
-        self.save()
+        # only the request actually archiving it updates the count
+        if Notice.objects.filter(pk=self.pk, archived=False).update(
+                archived=True) and counted:
+            UnseenNoticeCount.objects.adjust({self.recipient_id: -1})
+
+    def mark_seen(self):
+        """
+        marks the notice seen and updates the unseen count of its recipient.
+        """
+        counted = self.counts_as_unseen()
+        self.unseen = False
+        # only the request actually marking it seen updates the count
+        if Notice.objects.filter(pk=self.pk, unseen=True).update(
+                unseen=False) and counted:
+            UnseenNoticeCount.objects.adjust({self.recipient_id: -1})
 
     def is_unseen(self):
         """
         returns value of self.unseen but also changes it to false.
 
         Use this in a template to mark an unseen notice differently the first
-        time it is shown.
+        time it is shown. While notices are deferred (see
+        defer_seen_notices) the notice is saved as seen by the next
+        flush_seen_notices, along with the others shown.
         """
         unseen = self.unseen
         if unseen:
-            self.unseen = False
-            self.save()
+            deferred = getattr(seen_notices, "pks", None)
+            if deferred is None:
+                self.mark_seen()
+            else:
+                self.unseen = False
+                deferred.add(self.pk)
         return unseen
 
     class Meta:
+        # the composite indexes matching NoticeManager.notices_for, with and
+        # without on_site, are created by migrations 0009, 0010 and 0012
         ordering = ["-added"]
         verbose_name = _("notice")
         verbose_name_plural = _("notices")
@@ -152,12 +202,105 @@ class Notice(models.Model):
         return reverse("notification_notice", args=[str(self.pk)])
 
 
+# the notices marked seen by Notice.is_unseen in the current thread, see
+# defer_seen_notices
+seen_notices = threading.local()
+
+
+def defer_seen_notices():
+    """
+    Makes Notice.is_unseen record the notices to mark seen instead of
+    updating them one by one, until flush_seen_notices is called.
+    """
+    seen_notices.pks = set()
+
+
+def flush_seen_notices():
+    """
+    Marks the notices recorded since defer_seen_notices seen with a single
+    update and stops recording them.
+    """
+    pks = getattr(seen_notices, "pks", None)
+    seen_notices.pks = None
+    if pks:
+        Notice.objects.mark_seen(list(pks))
+
+
+class UnseenNoticeCount(models.Model):
+    """
+    The number of unseen notices shown on site to a user, maintained when
+    notices are created, seen, archived and deleted so the context processor
+    does not count them on every request. The reconcile_unseen_counts
+    command fixes the counters that drifted, e.g. after notices were updated
+    with a raw QuerySet update.
+    """
+    user = models.OneToOneField(User, primary_key=True, related_name="unseen_notice_count", verbose_name=_("user"))
+    count = models.IntegerField(_("count"), default=0)
+
+    objects = UnseenNoticeCountManager()
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.user, self.count)
+
+
 class NoticeQueueBatch(models.Model):
     """
     A queued notice.
     Denormalized data for a notice.
+
+    Workers lease a batch before emitting it: ``locked_until`` is the end of
+    the lease and the batch is invisible to other workers until then.
+    ``progress`` is the number of recipients already emitted and
+    ``attempts`` the number of times emitting the batch failed. Batches
+    with a higher ``priority`` are emitted first and get a larger share of
+    the workers.
     """
     pickled_data = models.TextField()
+    locked_until = models.DateTimeField(null=True, blank=True, db_index=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    priority = models.IntegerField(default=0, db_index=True)
+    progress = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+
+    objects = NoticeQueueBatchManager()
+
+
+class FailedNoticePayload(models.Model):
+    """
+    The encoded batch data to send failed notices again, stored once for all
+    the recipients the notice failed for.
+    """
+    data = models.TextField()
+
+    objects = FailedNoticePayloadManager()
+
+
+class FailedNotice(models.Model):
+    """
+    A notice that could not be sent to its recipient through a backend.
+
+    ``payload`` holds the data to send it again and ``next_retry`` is None
+    once it will not be retried anymore.
+    """
+    recipient = models.ForeignKey(User, related_name="failed_notices", verbose_name=_("recipient"))
+    label = models.CharField(_("label"), max_length=40)
+    backend = models.CharField(_("backend"), max_length=128)
+    payload = models.ForeignKey(FailedNoticePayload, related_name="failed_notices")
+    exception = models.TextField(_("exception"))
+    retries = models.PositiveIntegerField(_("retries"), default=0)
+    next_retry = models.DateTimeField(_("next retry"), null=True, blank=True, db_index=True)
+    added = models.DateTimeField(_("added"), default=datetime.datetime.now)
+    last_failed = models.DateTimeField(_("last failed"), default=datetime.datetime.now)
+
+    objects = FailedNoticeManager()
+
+    def __unicode__(self):
+        return u"%s to %s through %s" % (self.label, self.recipient, self.backend)
+
+    class Meta:
+        ordering = ["-last_failed"]
+        verbose_name = _("failed notice")
+        verbose_name_plural = _("failed notices")
 
 
 def create_notice_type(label, display, description, default=2, verbosity=1):
@@ -208,6 +351,33 @@ def get_notification_language(user):
     raise LanguageStoreNotAvailable
 
 
+def get_notification_languages(users):
+    """
+    Returns a dictionary mapping user ids to the site-specific notification
+    language of the given users, loaded with chunked ``IN`` queries. Users
+    without a stored language are left out. Raises LanguageStoreNotAvailable
+    if this site does not use translated notifications.
+    """
+    if not getattr(settings, "NOTIFICATION_LANGUAGE_MODULE", False):
+        raise LanguageStoreNotAvailable
+    try:
+        app_label, model_name = (
+                settings.NOTIFICATION_LANGUAGE_MODULE.split('.'))
+        model = models.get_model(app_label, model_name)
+    except (ImportError, ImproperlyConfigured):
+        raise LanguageStoreNotAvailable
+    if model is None:
+        raise LanguageStoreNotAvailable
+    user_ids = [user.pk for user in users]
+    languages = {}
+    for i in xrange(0, len(user_ids), PREFERENCE_CHUNK_SIZE):
+        for language_model in model._default_manager.filter(
+                user__id__in=user_ids[i:i + PREFERENCE_CHUNK_SIZE]):
+            if hasattr(language_model, "language"):
+                languages[language_model.user_id] = language_model.language
+    return languages
+
+
 def send_now(users, label, extra_context=None, on_site=True, sender=None,
         **kwargs):
     """
@@ -222,7 +392,26 @@ def send_now(users, label, extra_context=None, on_site=True, sender=None,
 
     You can pass in on_site=False to prevent the notice emitted from being
     displayed on the site.
+
+    Pass concurrent=True (or set NOTIFICATION_CONCURRENT_BACKENDS) to run the
+    I/O-bound backends on bounded worker threads.
+
+    A list of backend slugs can be passed as ``backends`` to only send
+    through those backends. With a RateLimiter passed as ``limiter`` the
+    sends over a backend's rate limit are not done but handed to the
+    limiter's ``defer``. With an ``on_error(backend, recipient, exc_info)``
+    callable passed as ``on_error`` a send failing for one recipient is
+    reported to it and the other sends go on.
+
+    Returns a dictionary mapping each backend slug to the number of notices
+    it ``sent``, ``skipped``, ``failed`` and ``deferred``.
     """
+    concurrent = kwargs.pop("concurrent", CONCURRENT_BACKENDS)
+    limiter = kwargs.pop("limiter", None)
+    only = kwargs.pop("backends", None)
+    on_error = kwargs.pop("on_error", None)
+    send_backends = [backend for backend in backends
+            if only is None or backend.slug in only]
     if extra_context is None:
         extra_context = {}
 
@@ -237,35 +426,84 @@ def send_now(users, label, extra_context=None, on_site=True, sender=None,
 
     current_language = get_language()
 
-    for user in users:
-        recipients = []
-        # get user language for user from language store defined in
-        # NOTIFICATION_LANGUAGE_MODULE setting
+    users = list(users)
+    # resolve the preferences of every recipient for every backend up front
+    # instead of one query per user and backend
+    preferences = NoticeSetting.objects.settings_for(users, notice_type,
+            send_backends)
+
+    # get the language of every user from the language store defined in
+    # NOTIFICATION_LANGUAGE_MODULE setting
+    try:
+        languages = get_notification_languages(users)
+    except LanguageStoreNotAvailable:
+        languages = {}
+    language_for = lambda user: languages.get(user.pk)
+    # deliver to the users grouped by language so each translation is only
+    # activated once
+    users.sort(key=language_for)
+
+    pool = BackendPool(send_backends, concurrent, on_error)
+    open_backends(send_backends, on_error)
+    try:
+        for backend in send_backends:
+            backend.prepare(sender, users, notice_type)
+
+        for language, group in groupby(users, language_for):
+            if language is not None:
+                # activate the users' language
+                activate(language)
+            else:
+                activate(current_language)
+            notice = ugettext(notice_type.display)
+
+            for user in group:
+                # update context with user specific translations
+                context = Context({
+                    "recipient": user,
+                    "sender": sender,
+                    "notice": notice,
+                    "protocol": protocol,
+                    "current_site": current_site,
+                })
+                context.update(extra_context)
+                # shared by the backends so every format is rendered only once
+                # for this recipient
+                context.render_memo = {}
+
+                for backend in send_backends:
+                    # only sends the backend actually does use up the limit
+                    if limiter is not None and backend.should_send(sender,
+                            user, notice_type, preferences=preferences) and \
+                            not limiter.allow(backend):
+                        limiter.defer(user, backend)
+                        pool.defer(backend)
+                        continue
+                    pool.send(backend, sender, user, notice_type, context,
+                            on_site=on_site, preferences=preferences,
+                            **kwargs)
+    finally:
         try:
-            language = get_notification_language(user)
-        except LanguageStoreNotAvailable:
-            language = None
-
-        if language is not None:
-            # activate the user's language
-            activate(language)
-
-        # update context with user specific translations
-        context = Context({
-            "recipient": user,
-            "sender": sender,
-            "notice": ugettext(notice_type.display),
-            "protocol": protocol,
-            "current_site": current_site,
-        })
-        context.update(extra_context)
-
-        for backend in backends:
-            backend.send(sender, user, notice_type, context, on_site=on_site,
-                    **kwargs)
+            results = pool.join()
+        finally:
+            # flush the work the backends buffered during this call
+            close_backends(send_backends)
 
     # reset environment to original language
     activate(current_language)
+    return results
+
+
+def send_async(*args, **kwargs):
+    """
+    Non-blocking counterpart of send_now, taking the same arguments. The
+    notices are sent on a background thread with the I/O-bound backends
+    running concurrently, and a handle is returned right away: its
+    ``done()``, ``wait(timeout)`` and ``result()`` methods report on the
+    send and ``result()`` returns what send_now returned.
+    """
+    kwargs.setdefault("concurrent", True)
+    return PendingSend(send_now, *args, **kwargs)
 
 
 def send(*args, **kwargs):
@@ -295,24 +533,34 @@ def queue(users, label, extra_context=None, on_site=True, sender=None,
     Queue the notification in NoticeQueueBatch. This allows for large amounts
     of user notifications to be deferred to a seperate process running outside
     the webserver.
+
+    The recipients are split in batches of at most
+    NOTIFICATION_QUEUE_BATCH_SIZE users and a QuerySet of users is iterated
+    in primary key order without loading it all at once, unless it is
+    sliced. The batches get the priority NOTIFICATION_PRIORITIES gives to the
+    notice type.
     """
     if extra_context is None:
         extra_context = {}
-    if isinstance(users, QuerySet):
-        users = [row["pk"] for row in users.values("pk")]
+    if isinstance(users, QuerySet) and not users.query.low_mark and \
+            users.query.high_mark is None:
+        user_ids = iter_pks(users, QUEUE_BATCH_SIZE)
+    elif isinstance(users, QuerySet):
+        # a sliced QuerySet can neither be reordered nor filtered
+        user_ids = users.values_list("pk", flat=True)
     else:
-        users = [user.pk for user in users]
-    notices = []
-    for user in users:
-        notices.append((user, label, extra_context, on_site, sender, kwargs))
-    batch = NoticeQueueBatch(pickled_data=pickle.dumps(notices).encode(
-            "base64"))
-    batch.save()
-    
+        user_ids = (user.pk for user in users)
+
     # TODO could also send a task per notice and drop the whole batch
     # thing
     from notification.tasks import emit_notice_batch
-    emit_notice_batch.delay(batch.id)
+    for chunk in chunked(user_ids, QUEUE_BATCH_SIZE):
+        notices = codec.pack_notices(chunk, label, extra_context, on_site,
+                sender, kwargs)
+        batch = NoticeQueueBatch(pickled_data=codec.encode(notices),
+                priority=PRIORITIES.get(label, 0))
+        batch.save()
+        emit_notice_batch.delay(batch.id)
 
 
 class ObservedItem(models.Model):
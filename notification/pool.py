@@ -0,0 +1,192 @@
+import sys
+import Queue
+import threading
+
+from django.db import connection
+from django.utils.translation import activate, get_language
+
+from notification.settings import BACKEND_CONCURRENCY
+
+
+class BackendPool(object):
+    """
+    Dispatches backend sends and counts their results per backend.
+
+    When ``concurrent`` is True the sends of I/O-bound backends (those with
+    ``io_bound = True``) are handed to a bounded set of worker threads per
+    backend, ``NOTIFICATION_BACKEND_CONCURRENCY[slug]`` of them (4 by
+    default). All other backends, and therefore the database writes, run on
+    the calling thread. Errors raised on worker threads are re-raised by
+    ``join`` once every queued send has been processed.
+
+    When an ``on_error`` callable is given, a send failing for a recipient
+    does not interrupt the others: ``on_error(backend, recipient, exc_info)``
+    is called for it on the calling thread instead.
+    """
+
+    def __init__(self, backends, concurrent=False, on_error=None):
+        self.on_error = on_error
+        self.results = {}
+        self.queues = {}
+        self.threads = []
+        self.errors = []
+        self.lock = threading.Lock()
+        for backend in backends:
+            self.results[backend.slug] = {"sent": 0, "skipped": 0,
+                    "failed": 0, "deferred": 0}
+            if concurrent and backend.io_bound:
+                workers = BACKEND_CONCURRENCY.get(backend.slug, 4)
+                queue = Queue.Queue(workers * 10)
+                self.queues[backend] = queue
+                for i in xrange(workers):
+                    thread = threading.Thread(target=self.work,
+                            args=(backend, queue))
+                    thread.setDaemon(True)
+                    thread.start()
+                    self.threads.append(thread)
+
+    def send(self, backend, *args, **kwargs):
+        queue = self.queues.get(backend)
+        if queue is not None:
+            # blocks while the backend's workers are saturated
+            queue.put((get_language(), args, kwargs))
+        elif self.on_error is None:
+            self.record(backend, backend.send(*args, **kwargs))
+        else:
+            try:
+                result = backend.send(*args, **kwargs)
+            except Exception:
+                self.fail(backend, args[1], sys.exc_info())
+            else:
+                self.record(backend, result)
+            self.report()
+
+    def record(self, backend, result):
+        self.lock.acquire()
+        try:
+            if result:
+                self.results[backend.slug]["sent"] += 1
+            else:
+                self.results[backend.slug]["skipped"] += 1
+        finally:
+            self.lock.release()
+
+    def defer(self, backend):
+        self.lock.acquire()
+        try:
+            self.results[backend.slug]["deferred"] += 1
+        finally:
+            self.lock.release()
+
+    def fail(self, backend, recipient, exc_info):
+        self.lock.acquire()
+        try:
+            self.results[backend.slug]["failed"] += 1
+            self.errors.append((backend, recipient, exc_info))
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """
+        Hands the failed sends of single recipients to ``on_error`` and
+        re-raises the first other error.
+        """
+        self.lock.acquire()
+        try:
+            errors, self.errors = self.errors, []
+        finally:
+            self.lock.release()
+        for backend, recipient, exc_info in errors:
+            if self.on_error is None or recipient is None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        for backend, recipient, exc_info in errors:
+            self.on_error(backend, recipient, exc_info)
+
+    def work(self, backend, queue):
+        on_error = None
+        if self.on_error is not None:
+            # handed to on_error on the calling thread by report
+            on_error = self.fail
+        backend.open(on_error)
+        try:
+            while True:
+                task = queue.get()
+                if task is None:
+                    break
+                language, args, kwargs = task
+                # translations are activated per thread
+                activate(language)
+                try:
+                    result = backend.send(*args, **kwargs)
+                except Exception:
+                    self.fail(backend, args[1], sys.exc_info())
+                else:
+                    self.record(backend, result)
+        finally:
+            try:
+                backend.close()
+            except Exception:
+                # not the failure of a single recipient
+                self.fail(backend, None, sys.exc_info())
+            # every thread gets its own database connection
+            connection.close()
+
+    def join(self):
+        """
+        Waits for the workers to process their queued sends and returns the
+        per-backend results.
+        """
+        for backend, queue in self.queues.items():
+            for i in xrange(BACKEND_CONCURRENCY.get(backend.slug, 4)):
+                queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues, self.threads = {}, []
+        self.report()
+        return self.results
+
+
+class PendingSend(object):
+    """
+    Handle on a call running on a background thread, as returned by
+    ``send_async``. The call runs with the caller's active language.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+        thread = threading.Thread(target=self.run,
+                args=(get_language(), function, args, kwargs))
+        thread.setDaemon(True)
+        thread.start()
+
+    def run(self, language, function, args, kwargs):
+        activate(language)
+        try:
+            try:
+                self.value = function(*args, **kwargs)
+            except Exception:
+                self.exc_info = sys.exc_info()
+        finally:
+            connection.close()
+            self.event.set()
+
+    def done(self):
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the call to finish and returns whether it did.
+        """
+        self.event.wait(timeout)
+        return self.done()
+
+    def result(self):
+        """
+        Waits for the call and returns its result, re-raising its error.
+        """
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
@@ -0,0 +1,120 @@
+import time
+
+from django.core.cache import cache
+
+from notification.settings import RATE_LIMITS
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` operations per second on average with bursts of up to
+    ``capacity`` operations. The operations are counted in the cache, so
+    every process using the same cache (the workers of emit_notices, the
+    daemons on every host, the celery workers) shares the limit: time is
+    divided in windows of ``capacity / rate`` seconds, each allowing
+    ``capacity`` operations.
+    """
+
+    def __init__(self, slug, rate, capacity):
+        self.slug = slug
+        self.rate = float(rate)
+        self.capacity = max(int(capacity), 1)
+        self.window = self.capacity / self.rate
+
+    def key(self, window):
+        return "notification_rate_%s_%s" % (self.slug, window)
+
+    def take(self, window, tokens, now):
+        """
+        Takes ``tokens`` tokens from the given window if it has them left
+        and returns whether it did.
+        """
+        key = self.key(window)
+        # kept until the window is over
+        timeout = int((window + 1) * self.window - now) + 1
+        cache.add(key, 0, timeout)
+        try:
+            count = cache.incr(key, tokens)
+        except ValueError:
+            # expired in between
+            cache.add(key, 0, timeout)
+            count = cache.incr(key, tokens)
+        return count <= self.capacity
+
+    def consume(self, tokens=1):
+        """
+        Takes ``tokens`` tokens if they are available and returns whether it
+        did. Never waits.
+        """
+        now = time.time()
+        return self.take(int(now / self.window), tokens, now)
+
+    def reserve(self, tokens):
+        """
+        Reserves ``tokens`` tokens in the first window after the current one
+        that has them left and returns the number of seconds until it
+        starts, so deferred operations are spread over time instead of all
+        becoming due at once.
+        """
+        # a window never holds more
+        tokens = min(tokens, self.capacity)
+        now = time.time()
+        # the windows before the one reserved last are known to be full
+        first_key = "notification_rate_%s_reserved" % self.slug
+        window = max(int(now / self.window) + 1, cache.get(first_key, 0))
+        while not self.take(window, tokens, now):
+            window += 1
+        cache.set(first_key, window,
+                int((window + 1) * self.window - now) + 1)
+        return window * self.window - now
+
+
+def get_bucket(slug):
+    """
+    Returns the bucket of the backend with the given slug, or None if the
+    backend is not rate limited. Limits are configured with
+    ``NOTIFICATION_RATE_LIMITS = {slug: (operations per second, burst)}``.
+    """
+    if slug not in RATE_LIMITS:
+        return None
+    return TokenBucket(slug, *RATE_LIMITS[slug])
+
+
+class RateLimiter(object):
+    """
+    Checks backend sends against the per-backend token buckets and collects
+    the sends that are over the limit, so the caller can defer them instead
+    of waiting.
+    """
+
+    def __init__(self):
+        self.deferred = []
+
+    def allow(self, backend):
+        bucket = get_bucket(backend.slug)
+        return bucket is None or bucket.consume()
+
+    def defer(self, user, backend):
+        self.deferred.append((user.pk, backend.slug))
+
+    def burst(self, slug):
+        """
+        Returns the number of sends of the backend with the given slug that
+        can be done at once, or None if the backend is not rate limited.
+        """
+        bucket = get_bucket(slug)
+        if bucket is None:
+            return None
+        return bucket.capacity
+
+    def reserve(self, slug, count=1):
+        """
+        Reserves the next free slot of the backend with the given slug for
+        ``count`` deferred sends, after the sends deferred before, and
+        returns the number of seconds until it. ``count`` should not exceed
+        the backend's ``burst``.
+        """
+        bucket = get_bucket(slug)
+        if bucket is None:
+            return 0.0
+        return bucket.reserve(count)
@@ -3,4 +3,34 @@ from django.conf import settings
 
 QUEUE_ALL = getattr(settings, "NOTIFICATION_QUEUE_ALL", False)
 OBSOLETE_DAYS = getattr(settings, "NOTIFICATION_OBSOLETE_DAYS", 30)
+OBSOLETE_DAYS_BY_TYPE = getattr(settings,
+        "NOTIFICATION_OBSOLETE_DAYS_BY_TYPE", {})
+PURGE_CHUNK_SIZE = getattr(settings, "NOTIFICATION_PURGE_CHUNK_SIZE", 1000)
+PURGE_DELAY = getattr(settings, "NOTIFICATION_PURGE_DELAY", 0)
 
+PREFERENCE_CHUNK_SIZE = getattr(settings, "NOTIFICATION_PREFERENCE_CHUNK_SIZE", 500)
+INSERT_CHUNK_SIZE = getattr(settings, "NOTIFICATION_INSERT_CHUNK_SIZE", 50)
+WEB_FLUSH_SIZE = getattr(settings, "NOTIFICATION_WEB_FLUSH_SIZE", 500)
+TEMPLATE_CACHE = getattr(settings, "NOTIFICATION_TEMPLATE_CACHE",
+        not settings.DEBUG)
+EMAIL_BATCH_SIZE = getattr(settings, "NOTIFICATION_EMAIL_BATCH_SIZE", 100)
+EMAIL_RETRIES = getattr(settings, "NOTIFICATION_EMAIL_RETRIES", 1)
+CONCURRENT_BACKENDS = getattr(settings, "NOTIFICATION_CONCURRENT_BACKENDS",
+        False)
+BACKEND_CONCURRENCY = getattr(settings, "NOTIFICATION_BACKEND_CONCURRENCY", {})
+FACEBOOK_BATCH_SIZE = getattr(settings, "NOTIFICATION_FACEBOOK_BATCH_SIZE", 50)
+RATE_LIMITS = getattr(settings, "NOTIFICATION_RATE_LIMITS", {})
+BATCH_CODEC = getattr(settings, "NOTIFICATION_BATCH_CODEC", "2")
+QUEUE_BATCH_SIZE = getattr(settings, "NOTIFICATION_QUEUE_BATCH_SIZE", 1000)
+EMIT_CHUNK_SIZE = getattr(settings, "NOTIFICATION_EMIT_CHUNK_SIZE", 100)
+BATCH_LEASE = getattr(settings, "NOTIFICATION_BATCH_LEASE", 300)
+SKIP_LOCKED = getattr(settings, "NOTIFICATION_SKIP_LOCKED", False)
+RETRY_DELAY = getattr(settings, "NOTIFICATION_RETRY_DELAY", 60)
+MAX_RETRIES = getattr(settings, "NOTIFICATION_MAX_RETRIES", 5)
+MAX_RETRY_DELAY = getattr(settings, "NOTIFICATION_MAX_RETRY_DELAY", 86400)
+ALERT_INTERVAL = getattr(settings, "NOTIFICATION_ALERT_INTERVAL", 3600)
+DAEMON_MIN_IDLE = getattr(settings, "NOTIFICATION_DAEMON_MIN_IDLE", 1)
+DAEMON_MAX_IDLE = getattr(settings, "NOTIFICATION_DAEMON_MAX_IDLE", 30)
+PRIORITIES = getattr(settings, "NOTIFICATION_PRIORITIES", {})
+INTERLEAVED_BATCHES = getattr(settings, "NOTIFICATION_INTERLEAVED_BATCHES", 4)
+PAGE_SIZE = getattr(settings, "NOTIFICATION_PAGE_SIZE", 50)
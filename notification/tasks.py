@@ -1,7 +1,10 @@
+import logging
+
 from celery.decorators import task
 
-from notification.engine import emit_batch
+from notification.engine import emit_batch, worker_name
 from notification.models import NoticeQueueBatch, Notice
+from notification.settings import BATCH_LEASE
 
 
 @task(ignore_result=True)
@@ -11,9 +14,18 @@ def emit_notice_batch(notice_batch_id, **kwargs):
     except NoticeQueueBatch.DoesNotExist, e:
         emit_notice_batch.retry(countdown=2, exc=e)
     else:
-        emit_batch(batch)
+        batch = NoticeQueueBatch.objects.claim(worker_name(), pk=batch.pk)
+        if batch is None:
+            # leased by another worker or not due yet; try again once the
+            # lease would have expired in case that worker crashed
+            emit_notice_batch.retry(countdown=BATCH_LEASE)
+        else:
+            emit_batch(batch)
 
 
 @task(ignore_result=True)
 def delete_obsolete_notices(**kwargs):
-    return Notice.objects.delete_obsolete_notices()
+    def progress(deleted, last):
+        logging.info("%s obsolete notices deleted, up to id %s" % (deleted,
+                last))
+    return Notice.objects.delete_obsolete_notices(progress=progress)
@@ -0,0 +1,434 @@
+import socket
+import smtpd
+import asyncore
+import datetime
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase
+from django.utils import simplejson, unittest
+
+from notification import codec, engine
+from notification.backends import backends, email
+from notification.models import Notice, NoticeType, NoticeQueueBatch, \
+        FailedNotice, FailedNoticePayload, create_notice_type
+from notification.ratelimit import TokenBucket
+
+try:
+    import facebook
+    from notification.backends import fb
+except ImportError:
+    fb = None
+
+
+class Recipient(object):
+
+    def __init__(self, pk, email=""):
+        self.pk = pk
+        self.email = email
+
+    def __repr__(self):
+        return "<Recipient %s>" % self.pk
+
+
+class NoticeTypeStub(object):
+    label = "test"
+
+
+class SMTPChannel(smtpd.SMTPChannel):
+
+    def __init__(self, server, conn, addr):
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+        self.stub, self.peer = server, addr
+
+    def smtp_MAIL(self, arg):
+        if self.stub.delivered.get(self.peer, 0) >= self.stub.drop_after:
+            # hang up on the client as a restarted server would
+            self.close()
+            return
+        smtpd.SMTPChannel.smtp_MAIL(self, arg)
+
+    def smtp_RCPT(self, arg):
+        if "refused" in arg:
+            self.push("550 no such user")
+            return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+
+class SMTPServer(smtpd.SMTPServer):
+    """
+    A local mail server collecting the messages it receives. With
+    ``drop_after`` it closes every connection after that many messages and
+    it refuses the recipients whose address contains "refused".
+    """
+
+    def __init__(self, drop_after=None):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.drop_after = drop_after or float("inf")
+        self.connections = 0
+        self.delivered = {}
+        self.messages = []
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connections += 1
+            SMTPChannel(self, *pair)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(rcpttos)
+        self.delivered[peer] = self.delivered.get(peer, 0) + 1
+
+
+class StubEmailBackend(email.EmailBackend):
+
+    def should_send(self, sender, recipient, notice_type, *args, **kwargs):
+        return True
+
+    def render_message(self, label, template, format, context):
+        return u"notice"
+
+
+class SMTPTestCase(TestCase):
+    """
+    Sends the e-mails of the test to an SMTPServer started by
+    ``start_server``.
+    """
+
+    def setUp(self):
+        self.settings = (settings.EMAIL_BACKEND, settings.EMAIL_HOST,
+                settings.EMAIL_PORT, email.EMAIL_BATCH_SIZE)
+        settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+        settings.EMAIL_HOST = "127.0.0.1"
+        self.server = None
+
+    def tearDown(self):
+        (settings.EMAIL_BACKEND, settings.EMAIL_HOST, settings.EMAIL_PORT,
+                email.EMAIL_BATCH_SIZE) = self.settings
+        if self.server is not None:
+            asyncore.close_all()
+            self.thread.join()
+
+    def start_server(self, **kwargs):
+        self.server = SMTPServer(**kwargs)
+        settings.EMAIL_PORT = self.server.port
+        self.thread = threading.Thread(target=asyncore.loop,
+                kwargs={"timeout": 0.05, "use_poll": True})
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+class EmailBackendTest(SMTPTestCase):
+
+    def setUp(self):
+        super(EmailBackendTest, self).setUp()
+        self.backend = StubEmailBackend()
+        self.errors = []
+
+    def on_error(self, backend, recipient, exc_info):
+        self.errors.append((recipient, exc_info[0]))
+
+    def send(self, recipients):
+        self.backend.open(self.on_error)
+        try:
+            for recipient in recipients:
+                self.backend.send(None, recipient, NoticeTypeStub(), {})
+        finally:
+            self.backend.close()
+
+    def test_batch_sent_in_chunks_over_one_connection(self):
+        self.start_server()
+        email.EMAIL_BATCH_SIZE = 2
+        recipients = [Recipient(i, "user%s@example.com" % i)
+                for i in range(5)]
+        self.backend.open(self.on_error)
+        try:
+            for recipient in recipients[:3]:
+                self.backend.send(None, recipient, NoticeTypeStub(), {})
+            # the first chunk is delivered once it is full
+            self.assertEqual(len(self.server.messages), 2)
+            for recipient in recipients[3:]:
+                self.backend.send(None, recipient, NoticeTypeStub(), {})
+        finally:
+            self.backend.close()
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.errors, [])
+
+    def test_reconnects_when_the_server_hangs_up(self):
+        self.start_server(drop_after=2)
+        recipients = [Recipient(i, "user%s@example.com" % i)
+                for i in range(3)]
+        self.send(recipients)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.errors, [])
+
+    def test_reconnects_every_time_the_server_hangs_up(self):
+        self.start_server(drop_after=2)
+        recipients = [Recipient(i, "user%s@example.com" % i)
+                for i in range(6)]
+        self.send(recipients)
+        self.assertEqual(len(self.server.messages), 6)
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.errors, [])
+
+    def test_refused_recipient_reported(self):
+        self.start_server()
+        refused = Recipient(2, "refused@example.com")
+        recipients = [Recipient(1, "user1@example.com"), refused,
+                Recipient(3, "user3@example.com")]
+        self.send(recipients)
+        self.assertEqual(self.server.messages, [["user1@example.com"],
+                ["user3@example.com"]])
+        self.assertEqual(len(self.errors), 1)
+        self.assertEqual(self.errors[0][0], refused)
+
+    def test_unreachable_server_reports_every_recipient(self):
+        # a port nobody listens on
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        settings.EMAIL_PORT = listener.getsockname()[1]
+        listener.close()
+        recipients = [Recipient(i, "user%s@example.com" % i)
+                for i in range(3)]
+        self.send(recipients)
+        self.assertEqual([recipient for recipient, error in self.errors],
+                recipients)
+
+
+class StubEmailTestCase(SMTPTestCase):
+    """
+    Sends the notices of the test through a StubEmailBackend registered in
+    place of the e-mail backend.
+    """
+
+    def setUp(self):
+        super(StubEmailTestCase, self).setUp()
+        # the registered e-mail backend is replaced for the test
+        self.replaced = [backend for backend in backends
+                if backend.slug == "email"]
+        backends.difference_update(self.replaced)
+        backends.add(StubEmailBackend())
+        self.start_server()
+
+    def tearDown(self):
+        backends.difference_update([backend for backend in backends
+                if backend.slug == "email"])
+        backends.update(self.replaced)
+        super(StubEmailTestCase, self).tearDown()
+
+    def queue(self, label, addresses):
+        create_notice_type(label, label, label, verbosity=0)
+        users = [User.objects.create(username=address.split("@")[0],
+                email=address) for address in addresses]
+        notices = codec.pack_notices([user.pk for user in users], label, {},
+                True, None, {"backends": ["email"]})
+        NoticeQueueBatch(pickled_data=codec.encode(notices)).save()
+
+
+class InterleavedBatchesTest(StubEmailTestCase):
+
+    def test_flush_failures_recorded_for_their_batch(self):
+        self.queue("alpha", ["u1@example.com", "u2@example.com"])
+        self.queue("beta", ["refused3@example.com", "refused4@example.com",
+                "refused5@example.com"])
+        batches, sent, failed = engine.schedule("test", chunk_size=1,
+                width=4)
+        self.assertEqual((batches, sent, failed), (2, 5, {"email": 3}))
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(sorted([(failed.recipient.username, failed.label)
+                for failed in FailedNotice.objects.all()]), [
+                ("refused3", "beta"), ("refused4", "beta"),
+                ("refused5", "beta")])
+
+
+class RetryFailedTest(StubEmailTestCase):
+
+    def test_failures_retried_together(self):
+        create_notice_type("beta", "beta", "beta", verbosity=0)
+        users = [User.objects.create(username=username,
+                email="%s@example.com" % username)
+                for username in ["u1", "u2", "refused3"]]
+        payload = engine.failure_payload("beta", {}, True, None,
+                {"backends": ["email"]})
+        FailedNotice.objects.record([user.pk for user in users], "beta",
+                "email", payload, "exception")
+        self.assertEqual(FailedNoticePayload.objects.count(), 1)
+        self.start_server()
+        sent = engine.retry_failed(FailedNotice.objects.select_related(
+                "recipient"))
+        self.assertEqual(sent, 2)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 2)
+        failed = FailedNotice.objects.get()
+        self.assertEqual((failed.recipient.username, failed.retries),
+                ("refused3", 1))
+        self.assertEqual(FailedNoticePayload.objects.delete_unused(), 0)
+        failed.delete()
+        self.assertEqual(FailedNoticePayload.objects.delete_unused(), 1)
+
+
+class CheckpointTest(TransactionTestCase):
+
+    def test_nothing_written_when_the_lease_was_lost(self):
+        user = User.objects.create(username="u1")
+        batch = NoticeQueueBatch(pickled_data="", locked_by="test")
+        batch.save()
+        # another worker took the batch over
+        NoticeQueueBatch.objects.filter(pk=batch.pk).update(
+                locked_by="other")
+        self.assertRaises(engine.LeaseLost, engine.checkpoint, batch, 1, [],
+                [([user.pk], "label", "email", FailedNoticePayload(data=""),
+                "exception")])
+        self.assertEqual(FailedNotice.objects.count(), 0)
+        self.assertEqual(NoticeQueueBatch.objects.get(pk=batch.pk).progress,
+                0)
+
+
+class DeleteObsoleteNoticesTest(TestCase):
+
+    def test_progress_reported_for_every_chunk(self):
+        user = User.objects.create(username="u1")
+        notice_type = NoticeType.objects.create(label="label",
+                display="label", description="label", default=2)
+        notices = [Notice.objects.create(recipient=user, message="notice",
+                notice_type=notice_type, unseen=False,
+                added=datetime.datetime(2000, 1, 1)) for i in range(5)]
+        calls = []
+        deleted = Notice.objects.delete_obsolete_notices(chunk_size=2,
+                delay=0, progress=lambda *args: calls.append(args))
+        self.assertEqual(deleted, 5)
+        self.assertEqual(calls, [(2, notices[1].pk), (4, notices[3].pk),
+                (5, notices[4].pk)])
+        self.assertEqual(Notice.objects.count(), 0)
+
+
+class TokenBucketTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def buckets(self):
+        # the buckets of two processes, with windows of 4000 seconds
+        return TokenBucket("email", 0.001, 4), TokenBucket("email", 0.001, 4)
+
+    def test_limit_shared_through_the_cache(self):
+        first, second = self.buckets()
+        taken = [first.consume() for i in range(3)] + [second.consume()
+                for i in range(2)]
+        self.assertEqual(taken, [True, True, True, True, False])
+
+    def test_reservations_spread_over_windows(self):
+        first, second = self.buckets()
+        delays = [first.reserve(4), second.reserve(4), first.reserve(2),
+                second.reserve(2)]
+        # one window per burst, the two halves share one
+        self.assertTrue(0 < delays[0] <= 4000)
+        self.assertAlmostEqual(delays[1] - delays[0], 4000, 0)
+        self.assertAlmostEqual(delays[2] - delays[1], 4000, 0)
+        self.assertAlmostEqual(delays[3], delays[2], 0)
+
+
+class FakeGraphAPI(object):
+    """
+    Answers batched Graph API requests like Facebook does, rejecting the
+    posts to the profile ids in ``rejected``, or fails every request with
+    ``error``.
+    """
+
+    def __init__(self, rejected=(), error=None):
+        self.rejected = rejected
+        self.error = error
+        self.batches = []
+
+    def request(self, path, args=None, post_args=None):
+        batch = simplejson.loads(post_args["batch"])
+        self.batches.append(batch)
+        if self.error is not None:
+            raise self.error
+        responses = []
+        for request in batch:
+            if request["relative_url"].split("/")[0] in self.rejected:
+                responses.append({"code": 400, "body": simplejson.dumps(
+                        {"error": {"message": "rejected"}})})
+            else:
+                responses.append({"code": 200, "body": '{"id": "1"}'})
+        return responses
+
+
+if fb is not None:
+
+    class GraphAPIDown(facebook.GraphAPIError):
+
+        def __init__(self):
+            Exception.__init__(self, "service unavailable")
+
+
+    class StubWallPostBackend(fb.FacebookWallPostBackend):
+
+        def __init__(self, graph):
+            self.graph = graph
+
+        def should_send(self, sender, recipient, notice_type, *args,
+                **kwargs):
+            return True
+
+        def render_message(self, label, template, format, context):
+            return u"notice"
+
+        def graph_api(self, user):
+            return self.graph
+
+        def facebook_user_id(self, user):
+            return unicode(user.pk)
+
+
+@unittest.skipIf(fb is None, "the facebook module is not installed")
+class FacebookWallPostBackendTest(TestCase):
+
+    def setUp(self):
+        self.batch_size = fb.FACEBOOK_BATCH_SIZE
+        self.errors = []
+
+    def tearDown(self):
+        fb.FACEBOOK_BATCH_SIZE = self.batch_size
+
+    def on_error(self, backend, recipient, exc_info):
+        self.errors.append((recipient, exc_info[0]))
+
+    def send(self, graph, recipients):
+        backend = StubWallPostBackend(graph)
+        backend.open(self.on_error)
+        try:
+            for recipient in recipients:
+                backend.send(Recipient(0), recipient, NoticeTypeStub(), {})
+        finally:
+            backend.close()
+
+    def test_posts_batched(self):
+        fb.FACEBOOK_BATCH_SIZE = 2
+        graph = FakeGraphAPI()
+        self.send(graph, [Recipient(i) for i in range(1, 6)])
+        self.assertEqual([[request["relative_url"] for request in batch]
+                for batch in graph.batches], [["1/feed", "2/feed"],
+                ["3/feed", "4/feed"], ["5/feed"]])
+        self.assertEqual(self.errors, [])
+
+    def test_rejected_posts_reported(self):
+        graph = FakeGraphAPI(rejected=["2"])
+        recipients = [Recipient(i) for i in range(1, 4)]
+        self.send(graph, recipients)
+        self.assertEqual(len(graph.batches), 1)
+        self.assertEqual(self.errors, [(recipients[1],
+                fb.WallPostRejected)])
+
+    def test_failed_batch_reported_for_every_post(self):
+        graph = FakeGraphAPI(error=GraphAPIDown())
+        recipients = [Recipient(i) for i in range(1, 4)]
+        self.send(graph, recipients)
+        self.assertEqual(self.errors, [(recipient, GraphAPIDown)
+                for recipient in recipients])
@@ -1,6 +1,12 @@
 import re
+import datetime
 import htmlentitydefs
 
+from django.conf import settings
+from django.db import models, connections, transaction
+
+from notification.settings import PREFERENCE_CHUNK_SIZE, INSERT_CHUNK_SIZE
+
 def unescape(text):
     """
     Removes HTML or XML character references and entities from a text string.
@@ -29,3 +35,126 @@ def unescape(text):
                 pass
         return text # leave as is
     return re.sub("&#?\w+;", fixup, text)
+
+
+def load_profiles(users):
+    """
+    Loads the profiles (``AUTH_PROFILE_MODULE``) of the given users with one
+    query per chunk of users and caches them on the user objects, so that
+    ``get_profile()`` does not hit the database anymore.
+    """
+    module = getattr(settings, "AUTH_PROFILE_MODULE", None)
+    if not module:
+        return
+    try:
+        app_label, model_name = module.split(".")
+    except ValueError:
+        return
+    model = models.get_model(app_label, model_name)
+    if model is None:
+        return
+    pending = {}
+    for user in users:
+        if not hasattr(user, "_profile_cache"):
+            pending.setdefault(user.pk, []).append(user)
+    user_ids = pending.keys()
+    for i in xrange(0, len(user_ids), PREFERENCE_CHUNK_SIZE):
+        for profile in model._default_manager.filter(
+                user__id__in=user_ids[i:i + PREFERENCE_CHUNK_SIZE]):
+            for user in pending[profile.user_id]:
+                user._profile_cache = profile
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most ``size`` items from ``iterable``.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def insert_many(manager, objects, chunk_size=INSERT_CHUNK_SIZE):
+    """
+    Inserts the given unsaved model instances with one query per chunk of
+    ``chunk_size`` objects. Like ``bulk_create``, which is used where Django
+    provides it (1.4 and later), no signals are sent and the primary keys of
+    the objects are not set. On Django 1.3 a multi-row INSERT is built from
+    the model's fields.
+    """
+    if hasattr(manager, "bulk_create"):
+        for chunk in chunked(objects, chunk_size):
+            manager.bulk_create(chunk)
+        return
+    model = manager.model
+    connection = connections[manager.db]
+    quote = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields
+            if not isinstance(field, models.AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES " % (quote(model._meta.db_table),
+            ", ".join([quote(field.column) for field in fields]))
+    row = "(%s)" % ", ".join(["%s"] * len(fields))
+    cursor = connection.cursor()
+    for chunk in chunked(objects, chunk_size):
+        params = []
+        for obj in chunk:
+            for field in fields:
+                params.append(field.get_db_prep_save(field.pre_save(obj, True),
+                        connection=connection))
+        cursor.execute(sql + ", ".join([row] * len(chunk)), params)
+    transaction.commit_unless_managed(using=manager.db)
+
+
+def in_transaction(function, using=None):
+    """
+    Calls ``function`` in a transaction of its own and returns its result.
+    When the caller already manages a transaction, e.g. a view under
+    TransactionMiddleware, the work is left to that transaction instead of
+    committing the caller's unrelated work early.
+    """
+    if transaction.is_managed(using=using):
+        return function()
+    return transaction.commit_on_success(using=using)(function)()
+
+
+def iter_pks(queryset, chunk_size):
+    """
+    Yields the primary keys of ``queryset`` in ascending order, fetching them
+    ``chunk_size`` at a time with keyset pagination so the whole result is
+    never held in memory.
+    """
+    queryset = queryset.order_by("pk").values_list("pk", flat=True)
+    last = None
+    while True:
+        if last is None:
+            pks = list(queryset[:chunk_size])
+        else:
+            pks = list(queryset.filter(pk__gt=last)[:chunk_size])
+        if not pks:
+            break
+        for pk in pks:
+            yield pk
+        last = pks[-1]
+
+
+CURSOR_DATE_FORMAT = "%Y%m%d%H%M%S%f"
+
+def notice_cursor(notice):
+    """
+    Returns the pagination cursor of a notice: its ``added`` date and primary
+    key, which together identify its position in a list of notices.
+    """
+    return "%s-%s" % (notice.added.strftime(CURSOR_DATE_FORMAT), notice.pk)
+
+def parse_cursor(cursor):
+    """
+    Returns the ``(added, pk)`` position encoded by a cursor, raising
+    ValueError if it is not a valid cursor.
+    """
+    added, pk = cursor.split("-", 1)
+    return datetime.datetime.strptime(added, CURSOR_DATE_FORMAT), int(pk)
@@ -19,6 +19,9 @@ from notification.backends import backends
     #An atom feed for all unarchived :model:`notification.Notice`s for a user.
     #"""
     #url = "feed/%s" % request.user.username
+    #if "before" in request.GET:
+        ## the page of older notices linked by the feed
+        #url += "/%s" % request.GET["before"]
     #return feed(request, url, {
         #"feed": NoticeUserFeed,
     #})
@@ -35,12 +38,28 @@ def notices(request):
 
         notices
             A list of :model:`notification.Notice` objects that are not archived
-            and to be displayed on the site.
+            and to be displayed on the site, one page of
+            ``NOTIFICATION_PAGE_SIZE`` notices at a time.
+
+        next_cursor
+            The value of the ``before`` query parameter giving the page of
+            older notices, or ``None`` on the last page.
+
+        prev_cursor
+            The value of the ``after`` query parameter giving the page of
+            newer notices, or ``None`` on the first page.
     """
-    notices = Notice.objects.notices_for(request.user, on_site=True)
+    try:
+        notices, next_cursor, prev_cursor = Notice.objects.page_for(
+                request.user, before=request.GET.get("before"),
+                after=request.GET.get("after"), on_site=True)
+    except ValueError:
+        raise Http404
 
     return render_to_response("notification/notices.html", {
         "notices": notices,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
     }, context_instance=RequestContext(request))
 
 
@@ -128,8 +147,7 @@ def single(request, id, mark_seen=True):
         user = request.user
     if user == notice.recipient:
         if mark_seen and notice.unseen:
-            notice.unseen = False
-            notice.save()
+            notice.mark_seen()
         return render_to_response((
             'notification/%s/single.html' % (notice.notice_type.label),
             'notification/single.html'
@@ -202,5 +220,5 @@ def mark_all_seen(request):
     ``HttpResponseRedirect`` when complete.
     """
 
-    Notice.objects.notices_for(request.user, unseen=True).update(unseen=False)
+    Notice.objects.mark_all_seen(request.user)
     return HttpResponseRedirect(reverse("notification_notices"))